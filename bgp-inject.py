@@ -19,12 +19,23 @@
 # limitations under the License.
 #
 import argparse
+import asyncio
 import asyncore
+import bisect
+import collections
+import concurrent.futures
 import errno
+import fcntl
+import functools
 import ipaddress
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import pwd
+import signal
 import sys
 import socket
 import struct
@@ -33,6 +44,8 @@ import traceback
 from struct import unpack
 import time
 
+import genrt
+
 log = logging.getLogger("BGP-INJECT")
 # handler = logging.StreamHandler(sys.stderr)
 # handler.setLevel(logging.DEBUG)
@@ -44,138 +57,1738 @@ BGP_MSG_TYPE_OPEN = 1
 BGP_MSG_TYPE_UPDATE = 2
 BGP_MSG_TYPE_NOTIFICATION = 3
 BGP_MSG_TYPE_KEEPALIVE = 4
+BGP_MSG_TYPE_ROUTE_REFRESH = 5
 
 AS_TRANS = 23456
+BGP_HOLD_TIME = 120
 BGP_OPT_TYPE_CAP = 2
 BGP_CAP_TYPE_MPBGP = 1
+BGP_CAP_TYPE_EXTMSG = 6
 BGP_CAP_TYPE_AS4 = 65
+BGP_CAP_TYPE_ADDPATH = 69
+ADDPATH_RECEIVE = 1
+ADDPATH_SEND = 2
 BGP_ATTR_TYPE_AS4_PATH = 17
 
 MPBGP_IPV4_AFI = 1
 MPBGP_IPV6_AFI = 2
 MPBGP_UNICAST_SAFI = 1
+AFI_NAMES = {MPBGP_IPV4_AFI: "ipv4", MPBGP_IPV6_AFI: "ipv6"}
+
+BGP_HDR_LEN = 19
+BGPAF_LONGLEN = 0x10
+BGPAT_NEXTHOP = 3
+BGPAT_MP_REACH_NLRI = 14
+BGPAT_MP_UNREACH_NLRI = 15
+BGPAT_LARGE_COMMUNITY = 32
+
+
+# Size of the MsgReader receive buffer.
+RECV_BUFSIZE = 0x100000
+# Chunk size handed to each sendfile(2) call.
+SENDFILE_CHUNK = 0x1000000
+# Generated chunks in flight (being generated or waiting to be sent).
+GENERATE_DEPTH = 2
+# Bytes of replayed messages gathered into a single send.
+REPLAY_BATCH = 0x100000
+# Seconds between writes of the --record buffer.
+RECORD_FLUSH_INTERVAL = 1
+# Linux ioctl returning the bytes in a socket's send queue (TIOCOUTQ).
+SIOCOUTQ = 0x5411
+
+
+class Peer:
+    def __init__(self, peerip, peerport, peeras, rawfile, receive=False):
+        self.ip = peerip
+        self.port = peerport
+        self.asn = peeras
+        self.rawfile = rawfile
+        self.receive = receive
+        self.name = str((peerip, peerport))
+        # With --split-raw the (part, parts) of the raw file's messages to
+        # send.
+        self.share = None
+
+    @classmethod
+    def from_spec(cls, spec, rawfile, receive=False):
+        # ip,as or ip,port,as or ip,port,as,file
+        fields = spec.split(",")
+        if len(fields) == 2:
+            peerip, peeras = fields
+            peerport = 179
+        elif len(fields) == 3:
+            peerip, peerport, peeras = fields
+        else:
+            peerip, peerport, peeras, rawfile = fields
+        return cls(
+            ipaddress.ip_address(peerip), int(peerport), int(peeras), rawfile,
+            receive)
+
+
+def make_msg(typ, data):
+    marker = bytes((0xff, )) * 16
+    return marker + struct.pack("!HB", len(data) + 19, typ) + data
+
+
+class MsgReader:
+    # Frames the BGP messages received on sock. Data is received with
+    # recv_into straight into a preallocated buffer and messages are returned
+    # as memoryviews into it, valid until the next read. Only the partial
+    # message left at the end of the buffer is ever moved (to its start).
+    def __init__(self, loop, sock, bufsize=RECV_BUFSIZE):
+        self.loop = loop
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.last = 0
+        # Loop time data was last received, for the hold timer.
+        self.recv_time = loop.time()
+
+    def next(self):
+        # Return the next buffered complete message or None.
+        start = self.start
+        if self.end - start < BGP_HDR_LEN:
+            return None
+        msglen = unpack("!H", self.buf[start + 16:start + 18])[0]
+        if msglen < BGP_HDR_LEN or msglen > len(self.buf):
+            raise ConnectionError("Bad message length {}".format(msglen))
+        if self.end - start < msglen:
+            return None
+        self.last = start
+        self.start = start + msglen
+        return self.view[start:self.start]
+
+    def unread(self):
+        # Push back the message last returned, it is returned again next.
+        self.start = self.last
+
+    async def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start:
+            # Move the partial message to the start so the rest fits.
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        count = await self.loop.sock_recv_into(self.sock,
+                                               self.view[self.end:])
+        if not count:
+            raise ConnectionError("Connection closed by peer")
+        self.end += count
+        self.recv_time = self.loop.time()
+
+    async def read(self):
+        # Return the next message receiving more data as needed.
+        while True:
+            msg = self.next()
+            if msg is not None:
+                return msg
+            await self.fill()
+
+
+async def wait_writable(loop, sock):
+    fut = loop.create_future()
+
+    def writable():
+        if not fut.done():
+            fut.set_result(None)
+
+    loop.add_writer(sock.fileno(), writable)
+    try:
+        await fut
+    finally:
+        loop.remove_writer(sock.fileno())
 
 
-def ours(localip, routerid, asn, peerip, peerport, peeras, rawfile):
-    def get_msg(s, buf):
-        reqlen = 18
-        while reqlen > 0:
-            buf += s.recv(reqlen)
-            reqlen = 18 - len(buf)
-        totlen = struct.unpack("!H", buf[16:18])[0]
-        reqlen = totlen - 18
-        assert reqlen > 0
-        while reqlen > 0:
-            buf += s.recv(reqlen)
-            reqlen = totlen - len(buf)
-        return buf[:totlen], buf[totlen:]
-
-    def make_msg(typ, data):
-        marker = bytes((0xff, )) * 16
-        return marker + struct.pack("!HB", len(data) + 19, typ) + data
-
-    connected = False
-    recvbuf = b""
-    while not connected:
+def get_outq(sock):
+    # Return the bytes queued in the socket not yet acked by the peer, or
+    # None if not supported.
+    try:
+        buf = fcntl.ioctl(sock.fileno(), SIOCOUTQ, b"\x00" * 4)
+    except OSError:
+        return None
+    return struct.unpack("i", buf)[0]
+
+
+class SendStats:
+    # Counters for the data sent to a peer, sent() is called on every send
+    # so it only counts bytes. The senders of generated updates add their
+    # message and prefix counts, those of a raw file being sent are counted
+    # lazily from the position reached (see track()) when settle()d, from
+    # its index if it has one, else by walking the headers sent since (the
+    # prefixes then go uncounted).
+    def __init__(self, peer, sock, addpath=()):
+        self.peer = peer
+        self.sock = sock
+        # The AFIs for which ADD-PATH path identifiers are sent.
+        self.addpath = addpath
+        self.bytes = 0
+        self.msgs = 0
+        self.prefixes = 0
+        # Cleared once prefixes are sent without being counted.
+        self.pfxcounted = True
+        self.sends = 0
+        self.partial = 0
+        # The raw file (mapped) data being sent, its index, the offset sent
+        # up to, and the offset and number of the next message not counted.
+        self.data = None
+        self.index = None
+        self.pos = 0
+        self.msgoff = 0
+        self.msgno = 0
+        # UPDATEs received from the peer while sending.
+        self.received = 0
+        # Held while sending a run of whole messages so other messages
+        # (keepalives) only go out between them.
+        self.lock = asyncio.Lock()
+
+    def sent(self, count):
+        # count more bytes were sent.
+        self.sends += 1
+        self.bytes += count
+        self.pos += count
+
+    def track(self, data=None, offset=0, index=None):
+        # Count the messages of data (with index, if any) sent from offset
+        # on, which must be a message boundary. The default stops tracking.
+        self.settle()
+        if data is not None and not index:
+            self.pfxcounted = False
+        self.data = data
+        self.index = index
+        self.pos = self.msgoff = offset
+        if index:
+            self.msgno = index.find(offset)
+
+    def settle(self):
+        # Count the whole messages of the tracked data sent so far.
+        if self.data is None:
+            return
+        index = self.index
+        if index:
+            # The messages before the first starting at or after pos, the
+            # last of those only if it ends there.
+            msgno = index.find(self.pos)
+            if index.offset(msgno) > self.pos:
+                msgno -= 1
+            if msgno > self.msgno:
+                self.msgs += msgno - self.msgno
+                self.prefixes += index.prefixes(self.msgno, msgno)
+                self.msgno = msgno
+            return
+        data = self.data
+        pos = self.pos
+        msgoff = self.msgoff
+        while msgoff + 18 <= pos:
+            nextoff = msgoff + unpack("!H", data[msgoff + 16:msgoff + 18])[0]
+            if nextoff > pos:
+                break
+            msgoff = nextoff
+            self.msgs += 1
+        self.msgoff = msgoff
+
+
+async def send_stats(stats, interval, statsfile=None):
+    # Log the send rates every interval seconds while anything changes,
+    # optionally also as JSON lines to statsfile.
+    last = (0, 0, 0)
+    last_time = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.time()
+        outq = get_outq(stats.sock)
+        stats.settle()
+        counts = (stats.msgs, stats.prefixes, stats.bytes)
+        if counts == last and not outq:
+            last_time = now
+            continue
+        elapsed = now - last_time
+        msgrate, pfxrate, byterate = [(x - y) / elapsed
+                                      for x, y in zip(counts, last)]
+        # Time to drain the send queue at the current rate.
+        drain = None
+        if outq == 0:
+            drain = 0
+        elif outq and byterate:
+            drain = outq / byterate
+        if not stats.pfxcounted:
+            pfxrate = None
+        log.info(
+            "%s: %.0f msgs/s, %s prefixes/s, %.0f bytes/s, %d of %d sends partial, outq %s, drained in %s",
+            stats.peer.name, msgrate, "{:.0f}".format(pfxrate)
+            if pfxrate is not None else "n/a", byterate, stats.partial,
+            stats.sends, outq, "{:.3f}s".format(drain)
+            if drain is not None else None)
+        if statsfile:
+            statsfile.write(
+                json.dumps({
+                    "time": now,
+                    "peer": stats.peer.name,
+                    "msgs": stats.msgs,
+                    "prefixes":
+                    stats.prefixes if stats.pfxcounted else None,
+                    "bytes": stats.bytes,
+                    "msgs_s": msgrate,
+                    "prefixes_s": pfxrate,
+                    "bytes_s": byterate,
+                    "sends": stats.sends,
+                    "partial": stats.partial,
+                    "outq": outq,
+                    "drain_s": drain,
+                }) + "\n")
+        last = counts
+        last_time = now
+
+
+async def wait_drained(sock):
+    # Wait until the peer has acked everything queued on the socket, return
+    # False if that can't be known.
+    while True:
+        outq = get_outq(sock)
+        if outq is None:
+            return False
+        if not outq:
+            return True
+        await asyncio.sleep(0.01)
+
+
+async def send_data(loop, sock, data, stats, msgs=0):
+    # Like loop.sock_sendall() but counting the sends into stats, data must
+    # be whole messages, msgs of them if not otherwise counted.
+    data = memoryview(data)
+    dlen = len(data)
+    offset = 0
+    async with stats.lock:
+        while offset < dlen:
+            try:
+                once = sock.send(data[offset:])
+            except BlockingIOError:
+                await wait_writable(loop, sock)
+                continue
+            offset += once
+            stats.sent(once)
+            if offset < dlen:
+                stats.partial += 1
+                await wait_writable(loop, sock)
+        stats.msgs += msgs
+
+
+async def send_messages(loop, sock, msgs, stats, prefixes=0):
+    # Send the list of messages (bytes-likes) gathering up to IOV_MAX of them
+    # into each sendmsg(2), without concatenating them. The list is consumed.
+    # prefixes, the number of prefixes the messages carry, is counted once
+    # all are sent.
+    async with stats.lock:
+        while msgs:
+            segments = msgs[:genrt.IOV_MAX]
+            try:
+                once = sock.sendmsg(segments)
+            except BlockingIOError:
+                await wait_writable(loop, sock)
+                continue
+            stats.sends += 1
+            stats.bytes += once
+            # Drop the messages sent keeping the rest of a partial one.
+            done = 0
+            count = once
+            while done < len(msgs) and count >= len(msgs[done]):
+                count -= len(msgs[done])
+                done += 1
+            del msgs[:done]
+            stats.msgs += done
+            if count:
+                msgs[0] = memoryview(msgs[0])[count:]
+            if once < sum(len(x) for x in segments):
+                stats.partial += 1
+                await wait_writable(loop, sock)
+        stats.prefixes += prefixes
+
+
+def message_chunk_end(data, offset, end, index=None):
+    # Return the end of the whole messages of data (a mapped file) from
+    # offset making up about SENDFILE_CHUNK bytes (at most end). Without an
+    # index rather than walking the messages the next marker is searched for
+    # (in C) and taken if it begins a plausible header whose message is
+    # followed by another marker (or the end). Marker octets at the end of
+    # the previous message make the first match a few octets early, its
+    # "type" is then 0xff.
+    cend = offset + SENDFILE_CHUNK
+    if cend >= end:
+        return end
+    if index:
+        return index.offset(index.find(cend))
+    while True:
+        cend = data.find(genrt.BGP_MARKER, cend, end)
+        if cend < 0 or cend + BGP_HDR_LEN > end:
+            return end
+        nextoff = cend + unpack("!H", data[cend + 16:cend + 18])[0]
+        if (BGP_MSG_TYPE_OPEN <= data[cend + 18] <= BGP_MSG_TYPE_ROUTE_REFRESH
+                and cend + BGP_HDR_LEN <= nextoff <= end and
+            (nextoff == end or
+             data[nextoff:nextoff + 16] == genrt.BGP_MARKER)):
+            return cend
+        cend += 1
+
+
+async def send_raw_sendfile(loop,
+                            sock,
+                            rawf,
+                            peer,
+                            stats,
+                            index=None,
+                            start=0,
+                            end=None):
+    # Push the file (from start to end) to the socket inside the kernel, no
+    # userspace copies (the file is mapped only to find message boundaries
+    # and count the messages sent). The chunks end on message boundaries,
+    # found quicker with an index.
+    fd = rawf.fileno()
+    dlen = os.fstat(fd).st_size if end is None else end
+    if start >= dlen:
+        return
+    offset = start
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        stats.track(mm, start, index)
+        try:
+            while offset < dlen:
+                log.debug("Sending %d bytes of raw data to %s", dlen - offset,
+                          peer.name)
+                cend = message_chunk_end(mm, offset, dlen, index)
+                async with stats.lock:
+                    while offset < cend:
+                        want = cend - offset
+                        try:
+                            once = os.sendfile(sock.fileno(), fd, offset,
+                                               want)
+                        except BlockingIOError:
+                            await wait_writable(loop, sock)
+                            continue
+                        except OSError as ex:
+                            if ex.errno not in (errno.EINVAL, errno.ENOSYS):
+                                raise
+                            # Not something sendfile can handle (e.g., a
+                            # pipe).
+                            log.info(
+                                "sendfile unsupported (%s) falling back to mmap",
+                                str(ex))
+                            break
+                        if not once:
+                            raise ConnectionError(
+                                "Error sending {} bytes to {}".format(
+                                    dlen - offset, peer.name))
+                        offset += once
+                        stats.sent(once)
+                        if once < want:
+                            stats.partial += 1
+                if offset < cend:
+                    break
+        finally:
+            stats.track()
+    if offset < dlen:
+        # The fallback, only ever needed before anything was sent.
+        await send_raw_mmap(loop, sock, rawf, peer, stats, index, offset,
+                            dlen)
+
+
+async def send_raw_mmap(loop,
+                        sock,
+                        rawf,
+                        peer,
+                        stats,
+                        index=None,
+                        offset=0,
+                        end=None):
+    # Map the file and send from a memoryview in chunks of whole messages,
+    # no copies of the remaining data on partial sends.
+    if not os.fstat(rawf.fileno()).st_size:
+        # An empty file can't be mapped.
+        return
+    with mmap.mmap(rawf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        end = len(mm) if end is None else end
+        stats.track(mm, offset, index)
+        try:
+            with memoryview(mm) as view:
+                log.debug("Sending %d bytes of raw data to %s", end - offset,
+                          peer.name)
+                while offset < end:
+                    cend = message_chunk_end(mm, offset, end, index)
+                    await send_data(loop, sock, view[offset:cend], stats)
+                    offset = cend
+        finally:
+            stats.track()
+
+
+async def send_replay(loop,
+                      sock,
+                      rawf,
+                      peer,
+                      stats,
+                      speedup,
+                      replay_from,
+                      maxlen=genrt.BGP_MAX_MSG_LEN):
+    # Replay the UPDATEs of the BGP4MP trace rawf (from peer address
+    # replay_from, if given) with their recorded spacing divided by speedup,
+    # or as fast as possible if 0. The messages due are sent together, those
+    # longer than the session allows (maxlen) are skipped.
+    if not os.fstat(rawf.fileno()).st_size:
+        return
+    fromip = replay_from.packed if replay_from else None
+    count = skipped = oversized = 0
+    first_ts = last_ts = start = None
+    maxlag = 0
+    batch = []
+    batchlen = batchpfx = 0
+    with mmap.mmap(rawf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        records = genrt.read_bgp4mp(mm)
         try:
-            sock = socket.create_connection((str(peerip), peerport))
-        except socket.error:
-            log.warning("Failed to connect sleeping 5s")
-            time.sleep(5)
+            for ts, aslen, peerip, msg in records:
+                if fromip and peerip != fromip:
+                    continue
+                if msg[18] != BGP_MSG_TYPE_UPDATE:
+                    continue
+                if aslen != 4:
+                    # 2 octet AS paths would need rewriting for our session.
+                    skipped += 1
+                    continue
+                if len(msg) > maxlen:
+                    oversized += 1
+                    continue
+                if first_ts is None:
+                    first_ts = ts
+                    start = time.monotonic()
+                if speedup:
+                    due = start + (ts - first_ts) / speedup
+                    now = time.monotonic()
+                    if due > now:
+                        if batch:
+                            await send_messages(loop, sock, batch, stats,
+                                                batchpfx)
+                            batchlen = batchpfx = 0
+                        delay = due - time.monotonic()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    else:
+                        maxlag = max(maxlag, now - due)
+                batch.append(msg)
+                batchlen += len(msg)
+                batchpfx += update_prefix_count(msg, 0, stats.addpath)
+                count += 1
+                last_ts = ts
+                if batchlen >= REPLAY_BATCH:
+                    await send_messages(loop, sock, batch, stats, batchpfx)
+                    batchlen = batchpfx = 0
+        finally:
+            records.close()
+    if batch:
+        await send_messages(loop, sock, batch, stats, batchpfx)
+    if first_ts is None:
+        log.warning("No updates to replay to %s in %s", peer.name,
+                    rawf.name)
+        return
+    log.info(
+        "Replayed %d updates spanning %.3fs of trace to %s in %.3fs (max lag %.3fs), skipped %d 2 octet AS and %d oversized updates",
+        count, last_ts - first_ts, peer.name, time.monotonic() - start, maxlag,
+        skipped, oversized)
+
+
+def count_nlri(data, offset, end, pathid=False):
+    # Count the prefixes in a packed NLRI field, with pathid each preceded
+    # by its 4 octet ADD-PATH path identifier.
+    count = 0
+    skip = 4 if pathid else 0
+    while offset < end:
+        offset += skip
+        offset += 1 + (data[offset] + 7) // 8
+        count += 1
+    return count
+
+
+def update_prefix_count(data, offset, addpath=()):
+    # Return the number of prefixes (withdrawn or announced) in the update
+    # message starting at offset, addpath being the AFIs for which ADD-PATH
+    # path identifiers were negotiated.
+    end = offset + unpack("!H", data[offset + 16:offset + 18])[0]
+    offset += BGP_HDR_LEN
+    wlen = unpack("!H", data[offset:offset + 2])[0]
+    offset += 2
+    ipv4pathid = MPBGP_IPV4_AFI in addpath
+    count = count_nlri(data, offset, offset + wlen, ipv4pathid)
+    offset += wlen
+    alen = unpack("!H", data[offset:offset + 2])[0]
+    offset += 2
+    aend = offset + alen
+    while offset < aend:
+        aflags, atype = data[offset], data[offset + 1]
+        if aflags & BGPAF_LONGLEN:
+            vlen = unpack("!H", data[offset + 2:offset + 4])[0]
+            offset += 4
+        else:
+            vlen = data[offset + 2]
+            offset += 3
+        if atype == BGPAT_MP_REACH_NLRI:
+            # afi, safi, nexthop len, nexthop, reserved
+            pathid = unpack("!H", data[offset:offset + 2])[0] in addpath
+            nstart = offset + 4 + data[offset + 3] + 1
+            count += count_nlri(data, nstart, offset + vlen, pathid)
+        elif atype == BGPAT_MP_UNREACH_NLRI:
+            # afi, safi
+            pathid = unpack("!H", data[offset:offset + 2])[0] in addpath
+            count += count_nlri(data, offset + 3, offset + vlen, pathid)
+        offset += vlen
+    return count + count_nlri(data, aend, end, ipv4pathid)
+
+
+class Pacer:
+    # Sends whole messages at a target rate (updates or prefixes per second)
+    # using a token bucket that holds up to burst units. The bucket carries
+    # over between send() calls.
+    def __init__(self, rate, rateunit, burst):
+        self.rate = rate
+        self.rateunit = rateunit
+        self.burst = burst or max(1, rate // 100)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.msgcount = 0
+        # The prefixes sent, unless some were sent uncounted.
+        self.pfxcount = 0
+        self.pfxcounted = True
+
+    async def send(self, loop, sock, data, stats, stamp=None, counts=None):
+        # stamp, if given, is called with each batch just before sending it.
+        # counts, if given, iterates the prefix counts of the messages in data
+        # (from an index) saving parsing them.
+        rate = self.rate
+        dlen = len(data)
+        offset = 0
+        while offset < dlen:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * rate)
+            self.last = now
+            if self.tokens <= 0:
+                await asyncio.sleep(-self.tokens / rate + 1 / rate)
+                continue
+
+            # Gather as many messages as we have tokens for, we allow going
+            # into debt so a message costing more than the burst still goes
+            # out, the debt delays the next batch.
+            end = offset
+            msgs = 0
+            while end < dlen and self.tokens > 0:
+                mlen = unpack("!H", data[end + 16:end + 18])[0]
+                if counts:
+                    cost = next(counts)
+                elif self.rateunit != "prefixes":
+                    cost = None
+                elif data[end + 18] == BGP_MSG_TYPE_UPDATE:
+                    cost = update_prefix_count(data, end, stats.addpath)
+                else:
+                    cost = 0
+                if cost is None:
+                    self.pfxcounted = False
+                else:
+                    stats.prefixes += cost
+                    self.pfxcount += cost
+                self.tokens -= cost if self.rateunit == "prefixes" else 1
+                msgs += 1
+                end += mlen
+            self.msgcount += msgs
+            if stamp:
+                stamp(data[offset:end])
+            await send_data(loop, sock, data[offset:end], stats, msgs)
+            offset = end
+
+
+class UpdateTagger:
+    # Fills in the latency tag (see genrt.get_tag_offset()) of generated
+    # updates with a sequence number and the time they are sent.
+    def __init__(self):
+        self.seq = 0
+
+    def stamp(self, data, tagoff):
+        # Stamp the whole updates in the writable buffer data, tagoff being
+        # the tag offset from the start (or if negative the end) of each.
+        now = int(time.time() * 1000) & 0xFFFFFFFF
+        dlen = len(data)
+        offset = 0
+        while offset < dlen:
+            mlen = unpack("!H", data[offset + 16:offset + 18])[0]
+            pos = offset + (tagoff if tagoff >= 0 else mlen + tagoff)
+            struct.pack_into("!LL", data, pos, self.seq, now)
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            offset += mlen
+
+
+def get_raw_max_msglen(rawpath):
+    # Return the length of the longest message of the raw file rawpath from
+    # its index, None if it has none (walking the headers of a large file
+    # costs as much as sending it).
+    index = genrt.RawIndex.open(rawpath)
+    if not index:
+        return None
+    maxlen = max(index.lengths, default=0)
+    index.close()
+    return maxlen
+
+
+async def send_raw_paced(loop,
+                         sock,
+                         rawf,
+                         pacer,
+                         stats,
+                         index=None,
+                         first=0,
+                         last=None):
+    # Pace messages first to last - 1 of the file (all without an index).
+    counts = None
+    start = end = None
+    if not index and pacer.rateunit != "prefixes":
+        # Only counted (from each update) when pacing by them.
+        stats.pfxcounted = False
+    if index:
+        last = len(index) if last is None else last
+        counts = iter(index.counts[first:last])
+        start, end = index.offset(first), index.offset(last)
+    if not os.fstat(rawf.fileno()).st_size:
+        # An empty file can't be mapped.
+        return
+    with mmap.mmap(rawf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as data:
+            await pacer.send(loop, sock, data[start:end], stats, None,
+                             counts)
+
+
+def get_space_chunks(args,
+                     blocks,
+                     start,
+                     count,
+                     withdraw=False,
+                     maxlen=genrt.BGP_MAX_MSG_LEN):
+    # The genrt.gen_update_chunk() arguments announcing (or withdrawing)
+    # count prefixes beginning with prefix number start of the space made of
+    # the concatenated blocks, wrapping at its end, in updates of at most
+    # maxlen bytes.
+    total = sum(x[3] for x in blocks)
+    pos = start % total
+    chunks = []
+    while count:
+        for prefix, sublen, nexthop, bcount in blocks:
+            if pos >= bcount:
+                pos -= bcount
+                continue
+            n = min(bcount - pos, count)
+            chunks += genrt.get_update_chunks(
+                prefix, sublen, nexthop, args.max_pack, n, args.aspath,
+                args.root_as_inc, args.root_as_mod, pos, withdraw, args.tag,
+                args.ipv4_mp, args.profile, args.add_path, maxlen)
+            count -= n
+            pos = 0
+            if not count:
+                break
+    return chunks
+
+
+def get_generate_chunks(args, maxlen=genrt.BGP_MAX_MSG_LEN):
+    # The genrt.gen_update_chunk() arguments for the --generate triples in
+    # updates of at most maxlen bytes.
+    chunks = []
+    for prefix, sublen, nexthop, count in genrt.get_blocks(
+            args.generate, args.max_routes):
+        chunks += genrt.get_update_chunks(
+            prefix, sublen, nexthop, args.max_pack, count, args.aspath,
+            args.root_as_inc, args.root_as_mod, 0, False, args.tag,
+            args.ipv4_mp, args.profile, args.add_path, maxlen)
+    return chunks
+
+
+async def send_churn(loop,
+                     sock,
+                     executor,
+                     args,
+                     peer,
+                     stats,
+                     pacer=None,
+                     convergence=None,
+                     tagger=None,
+                     maxlen=genrt.BGP_MAX_MSG_LEN):
+    # The spec's test 2 loop: the initial load is a window of --max-routes
+    # prefixes of the --generate space, each cycle withdraws the oldest
+    # --churn prefixes of the window and announces the --churn following
+    # it, sliding the window along (and around) the space. With convergence
+    # each cycle is only started once the receiver holds the window.
+    blocks = genrt.get_blocks(args.generate, 0xFFFFFFFF)
+    total = sum(x[3] for x in blocks)
+    window = min(args.max_routes, total)
+    wstart = 0
+    cycle = 0
+    while not args.churn_cycles or cycle < args.churn_cycles:
+        await asyncio.sleep(args.churn_interval)
+        start_time = time.time()
+        if convergence:
+            convergence.expected.set_want(wstart, args.churn, False)
+            convergence.expected.set_want(wstart + window, args.churn, True)
+        await send_generated(
+            loop, sock, executor,
+            get_space_chunks(args, blocks, wstart, args.churn, True, maxlen),
+            stats, pacer, tagger)
+        down_time = time.time()
+        await send_generated(
+            loop, sock, executor,
+            get_space_chunks(args, blocks, wstart + window, args.churn, False,
+                             maxlen), stats, pacer, tagger)
+        up_time = time.time()
+        wstart = (wstart + args.churn) % total
+        cycle += 1
+        log.info(
+            "Churn cycle %d to %s: %d DOWN in %.3fs, %d UP in %.3fs, %.0f prefixes/s",
+            cycle, peer.name, args.churn, down_time - start_time, args.churn,
+            up_time - down_time, 2 * args.churn / (up_time - start_time))
+        if convergence:
+            await convergence.wait(peer, start_time, up_time)
+
+
+async def send_generated(loop,
+                         sock,
+                         executor,
+                         chunks,
+                         stats,
+                         pacer=None,
+                         tagger=None):
+    # Generate updates in the executor while the previous chunks are being
+    # sent, keeping up to GENERATE_DEPTH chunks in flight. With a tagger the
+    # (announcement) updates are stamped as they go out.
+    pending = collections.deque()
+    chunks = iter(chunks)
+
+    def generate(chunk):
+        # The chunk and its future updates.
+        return chunk, loop.run_in_executor(executor, genrt.gen_update_chunk,
+                                           chunk)
+
+    for chunk in itertools.islice(chunks, GENERATE_DEPTH):
+        pending.append(generate(chunk))
+    while pending:
+        sending, fut = pending.popleft()
+        data = await fut
+        chunk = next(chunks, None)
+        if chunk is not None:
+            pending.append(generate(chunk))
+        # The withdraw flag is the only difference tagging cares about.
+        stamp = None
+        if tagger and not sending[10]:
+            # The tag offset depends on the AS path length, next hop,
+            # ipv4mp and profile.
+            stamp = functools.partial(
+                tagger.stamp,
+                tagoff=genrt.get_tag_offset(sending[6], sending[2],
+                                            sending[12], sending[13]))
+        if pacer:
+            await pacer.send(loop, sock, memoryview(data), stats, stamp)
+        else:
+            if stamp:
+                stamp(data)
+            # npack prefixes per update.
+            await send_data(loop, sock, data, stats,
+                            (sending[5] + sending[3] - 1) // sending[3])
+        if not pacer or pacer.rateunit != "prefixes":
+            stats.prefixes += sending[5]
+
+
+def get_open_afis(openmsg):
+    # Return the AFIs of the unicast MPBGP capabilities in an OPEN message,
+    # just IPv4 if it has none.
+    afis = []
+    mpbgp = False
+    for ctype, value in get_open_caps(openmsg):
+        if ctype == BGP_CAP_TYPE_MPBGP and len(value) == 4:
+            mpbgp = True
+            afi, _, safi = unpack("!HBB", value)
+            if safi == MPBGP_UNICAST_SAFI:
+                afis.append(afi)
+    return afis if mpbgp else [MPBGP_IPV4_AFI]
+
+
+def get_open_addpath_afis(openmsg):
+    # Return the AFIs the ADD-PATH capability of an OPEN message can receive
+    # unicast path identifiers for.
+    afis = []
+    for ctype, value in get_open_caps(openmsg):
+        if ctype != BGP_CAP_TYPE_ADDPATH:
+            continue
+        for offset in range(0, len(value) - 3, 4):
+            afi, safi, mode = unpack("!HBB", value[offset:offset + 4])
+            if safi == MPBGP_UNICAST_SAFI and mode & ADDPATH_RECEIVE:
+                afis.append(afi)
+    return afis
+
+
+def get_open_caps(openmsg):
+    # Return the (type, value) of the capabilities in an OPEN message.
+    caps = []
+    offset = 29
+    end = offset + openmsg[28]
+    while offset + 2 <= end:
+        ptype, plen = openmsg[offset], openmsg[offset + 1]
+        offset += 2
+        pend = offset + plen
+        while ptype == BGP_OPT_TYPE_CAP and offset + 2 <= pend:
+            ctype, clen = openmsg[offset], openmsg[offset + 1]
+            offset += 2
+            caps.append((ctype, openmsg[offset:offset + clen]))
+            offset += clen
+        offset = pend
+    return caps
+
+
+async def connect(loop, args, peer):
+    # Connect to the peer and bring the session to established. Return the
+    # socket, its MsgReader, the hold time, maximum message length and the
+    # AFIs ADD-PATH path identifiers are sent for.
+    while True:
+        if peer.ip.version == 6:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (str(peer.ip), peer.port))
+        except OSError:
+            log.warning("Failed to connect to %s sleeping 5s", peer.name)
+            sock.close()
+            await asyncio.sleep(5)
             continue
 
-        if asn > 0xFFFF:
+        if args.asn > 0xFFFF:
             open_asn = AS_TRANS
         else:
-            open_asn = asn
+            open_asn = args.asn
 
-        log.info("CONNECT %s", str((peerip, peerport)))
+        log.info("CONNECT %s", peer.name)
 
-        data = struct.pack("!BHH", BGP_VERSION, open_asn, 120)
-        data += routerid.packed
+        data = struct.pack("!BHH", BGP_VERSION, open_asn, BGP_HOLD_TIME)
+        data += args.router_id.packed
         # Add optional params
         cap = b""
-        if peerip.version == 6:
-            # Add MPBGP capability
-            cap += struct.pack("!BBHBB", BGP_CAP_TYPE_MPBGP, 4, MPBGP_IPV4_AFI,
-                               0, MPBGP_UNICAST_SAFI)
+        if peer.receive:
+            # Add MPBGP capabilities for everything we can verify
+            afis = (MPBGP_IPV4_AFI, MPBGP_IPV6_AFI)
+        else:
+            # Add MPBGP capabilities for what we send
+            afis = args.afis
+        for afi in afis:
+            cap += struct.pack("!BBHBB", BGP_CAP_TYPE_MPBGP, 4, afi, 0,
+                               MPBGP_UNICAST_SAFI)
         # Add AS4 capability
-        cap += struct.pack("!BBL", BGP_CAP_TYPE_AS4, 4, asn)
+        cap += struct.pack("!BBL", BGP_CAP_TYPE_AS4, 4, args.asn)
+        if args.extended_message:
+            # Add extended message capability
+            cap += struct.pack("!BB", BGP_CAP_TYPE_EXTMSG, 0)
+        addpath = args.add_path and not peer.receive
+        if addpath:
+            # Add ADD-PATH capability, we only send path identifiers.
+            cap += struct.pack("!BB", BGP_CAP_TYPE_ADDPATH, 4 * len(afis))
+            for afi in afis:
+                cap += struct.pack("!HBB", afi, MPBGP_UNICAST_SAFI,
+                                   ADDPATH_SEND)
         opt = struct.pack("!BB", BGP_OPT_TYPE_CAP, len(cap))
         opt += cap
         data += bytes((len(opt), )) + opt
-        sock.send(make_msg(BGP_MSG_TYPE_OPEN, data))
-
-        log.info("SENT OPEN %s", str((peerip, peerport)))
 
-        # Receive the peer's open message.
-        openmsg, recvbuf = get_msg(sock, recvbuf)
-        msgtype = openmsg[18:19][0]
-
-        if msgtype != BGP_MSG_TYPE_OPEN:
-            log.error("Unexpected message type %d during CONNECT", msgtype)
-            log.warning("Failed to connect sleeping 5s")
+        try:
+            await loop.sock_sendall(sock, make_msg(BGP_MSG_TYPE_OPEN, data))
+            log.info("SENT OPEN %s", peer.name)
+
+            # Receive the peer's open message.
+            reader = MsgReader(loop, sock)
+            openmsg = await reader.read()
+            msgtype = openmsg[18:19][0]
+            if msgtype != BGP_MSG_TYPE_OPEN:
+                log.error("Unexpected message type %d during CONNECT",
+                          msgtype)
+                raise ConnectionError("OPEN not received")
+            # The lower of the hold times, 0 for none.
+            holdtime = min(BGP_HOLD_TIME, unpack("!H", openmsg[22:24])[0])
+            peer_afis = get_open_afis(openmsg)
+            for afi in afis:
+                if afi not in peer_afis and not peer.receive:
+                    log.warning("%s did not negotiate %s unicast", peer.name,
+                                AFI_NAMES[afi])
+            # Longer messages only once both sides advertised extended
+            # messages (RFC 8654).
+            maxlen = genrt.BGP_MAX_MSG_LEN
+            if args.extended_message:
+                if BGP_CAP_TYPE_EXTMSG in (x[0]
+                                           for x in get_open_caps(openmsg)):
+                    maxlen = genrt.BGP_EXT_MAX_MSG_LEN
+                else:
+                    log.warning(
+                        "%s did not negotiate extended messages, sending at most %d byte messages",
+                        peer.name, maxlen)
+            addpath_afis = ()
+            if addpath:
+                peer_afis = get_open_addpath_afis(openmsg)
+                for afi in afis:
+                    if afi not in peer_afis:
+                        log.warning("%s did not negotiate %s ADD-PATH",
+                                    peer.name, AFI_NAMES[afi])
+                addpath_afis = tuple(x for x in afis if x in peer_afis)
+
+            log.info("OPENCONFRIM %s", peer.name)
+
+            kamsg = make_msg(BGP_MSG_TYPE_KEEPALIVE, b"")
+            await loop.sock_sendall(sock, kamsg)
+
+            # Receive the peer's keepalive message.
+            keepalive = await reader.read()
+            msgtype = keepalive[18:19][0]
+            if msgtype != BGP_MSG_TYPE_KEEPALIVE and msgtype != BGP_MSG_TYPE_UPDATE:
+                log.error("Unexpected message type %d during OPEN", msgtype)
+                raise ConnectionError("KEEPALIVE not received")
+            if msgtype == BGP_MSG_TYPE_UPDATE:
+                # Leave it for the receive loop
+                reader.unread()
+        except OSError as ex:
+            log.warning("Failed to establish %s (%s) sleeping 5s", peer.name,
+                        str(ex))
             sock.close()
-            time.sleep(5)
+            await asyncio.sleep(5)
             continue
 
-        log.info("OPENCONFRIM %s", str((peerip, peerport)))
+        log.info("ESTABLISHED %s (assuming 4-octet AS numbers)", peer.name)
+        return sock, reader, holdtime, maxlen, addpath_afis
 
-        kamsg = make_msg(BGP_MSG_TYPE_KEEPALIVE, b"")
-        sent = sock.send(kamsg)
-        if sent != len(kamsg):
-            log.warning("Failed to send keepalive sleeping 5s")
-            sock.close()
-            time.sleep(5)
-            continue
 
-        # Receive the peer's keepalive message.
-        keepalive, recvbuf = get_msg(sock, recvbuf)
-        msgtype = keepalive[18:19][0]
-        if msgtype != BGP_MSG_TYPE_KEEPALIVE and msgtype != BGP_MSG_TYPE_UPDATE:
-            log.error("Unexpected message type %d during OPEN", msgtype)
-            log.warning("Failed to connect sleeping 5s")
-            sock.close()
-            time.sleep(5)
-            continue
+async def keepalive(loop, sock, peer, holdtime, reader, lock):
+    # Send a KEEPALIVE every third of the hold time, between whole messages
+    # (under lock), and fail the session once nothing was received from the
+    # peer for the hold time.
+    if not holdtime:
+        return
+    kamsg = make_msg(BGP_MSG_TYPE_KEEPALIVE, b"")
+    while True:
+        await asyncio.sleep(holdtime / 3)
+        if loop.time() - reader.recv_time > holdtime:
+            raise ConnectionError("Hold timer expired")
+        async with lock:
+            await loop.sock_sendall(sock, kamsg)
+        log.debug("Sent KeepAlive to %s", peer.name)
+
 
-        connected = True
-        log.info("ESTABLISHED %s (assuming 4-octet AS numbers)",
-                 str((peerip, peerport)))
-        break
+async def drain_peer(reader, stats):
+    # Read what the peer sends while we send to it so its updates (e.g., the
+    # router advertising routes back) don't back up, fail on a NOTIFICATION.
+    while True:
+        msg = await reader.read()
+        msgtype = msg[18]
+        if msgtype == BGP_MSG_TYPE_UPDATE:
+            stats.received += 1
+        elif msgtype == BGP_MSG_TYPE_NOTIFICATION:
+            raise ConnectionError("NOTIFICATION received: {}".format(
+                msg[19:].hex()))
+
+
+async def run_session(tasks):
+    # Run the tasks of a session until one fails, raising its exception, the
+    # others are then cancelled. Tasks may also finish normally.
+    try:
+        done, _ = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def ours(args, peer, executor=None, convergence=None, statsfile=None):
+    # Send to the peer while concurrently keeping the session up (keepalives
+    # and the hold timer) and draining what it sends us.
+    loop = asyncio.get_event_loop()
+    sock, reader, holdtime, maxlen, addpath = await connect(loop, args, peer)
+
+    stats = SendStats(peer, sock, addpath)
+    tasks = [
+        loop.create_task(
+            send_updates(loop, sock, args, peer, stats, executor,
+                         convergence, maxlen)),
+        loop.create_task(
+            keepalive(loop, sock, peer, holdtime, reader, stats.lock)),
+        loop.create_task(drain_peer(reader, stats)),
+    ]
+    if args.stats_interval:
+        tasks.append(
+            loop.create_task(
+                send_stats(stats, args.stats_interval, statsfile)))
+    try:
+        await run_session(tasks)
+    finally:
+        sock.close()
+
+
+async def send_updates(loop, sock, args, peer, stats, executor, convergence,
+                       maxlen):
+    # Send the generated, replayed or raw updates to the peer, no message
+    # may be longer than maxlen.
+    pacer = None
+    if args.rate:
+        pacer = Pacer(args.rate, args.rate_unit, args.burst)
+    tagger = None
+    if args.tag:
+        tagger = UpdateTagger()
+    if (peer.rawfile and not args.replay
+            and maxlen < genrt.BGP_EXT_MAX_MSG_LEN):
+        # A file generated with --extended-message can't be sent to a peer
+        # which did not negotiate it, checked before the clock starts when
+        # the file has an index. Without one the peer's NOTIFICATION will
+        # have to do.
+        msglen = get_raw_max_msglen(peer.rawfile)
+        if msglen is not None and msglen > maxlen:
+            raise ValueError(
+                "{} has {} byte messages but {} only accepts {}".format(
+                    peer.rawfile, msglen, peer.name, maxlen))
 
-    log.info("Loading raw data from %s", rawfile)
     start_time = time.time()
-    with open(rawfile, "rb") as rawf:
-        data = rawf.read()
-        dlen = len(data)
-        sent = 0
-        while dlen > 0:
-            log.info("Sending %d bytes of raw data to %s", dlen,
-                     str((peerip, peerport)))
-            once = sock.send(data)
-            if not once:
-                log.info("Error sending %d bytes to ", dlen,
-                         str((peerip, peerport)))
-            data = data[once:]
-            dlen -= once
-    # This doesn't work unfortunately
-    # while True:
-    #     SIOCOUTQ = 0x00005411
-    #     ioctl.ioctl(sock, SIOCOUTQ, 0)
+    if not peer.rawfile:
+        log.info("Sending generated updates to %s", peer.name)
+        if convergence:
+            convergence.expected.set_want(
+                0, min(args.max_routes, convergence.expected.total), True)
+        await send_generated(loop, sock, executor,
+                             get_generate_chunks(args, maxlen), stats, pacer,
+                             tagger)
+    elif args.replay:
+        log.info("Replaying BGP4MP trace %s to %s at %s", peer.rawfile,
+                 peer.name, "{}x".format(args.speedup)
+                 if args.speedup else "max speed")
+        with open(peer.rawfile, "rb") as rawf:
+            await send_replay(loop, sock, rawf, peer, stats,
+                              args.speedup, args.replay_from, maxlen)
+    else:
+        # Paced sends always go from an mmap, whatever --send-mode says.
+        log.info("Sending raw data from %s to %s using %s",
+                 peer.rawfile, peer.name,
+                 "paced mmap" if pacer else args.send_mode)
+        index = genrt.RawIndex.open(peer.rawfile)
+        first, last = args.msg_range
+        if index:
+            last = len(index) if last is None else min(last, len(index))
+            first = min(first, last)
+            if peer.share:
+                part, parts = peer.share
+                first, last = (first + (last - first) * part // parts,
+                               first + (last - first) * (part + 1) // parts)
+            start, end = index.offset(first), index.offset(last)
+            log.info("Sending messages %d to %d of %d (%d prefixes)",
+                     first, last, len(index), index.prefixes(first, last))
+        elif first or last is not None or peer.share:
+            raise ValueError(
+                "--msg-range and --split-raw need an index for {}".format(
+                    peer.rawfile))
+        else:
+            start, end = 0, None
+        with open(peer.rawfile, "rb") as rawf:
+            if pacer:
+                await send_raw_paced(loop, sock, rawf, pacer, stats,
+                                     index, first, last)
+            elif args.send_mode == "sendfile":
+                await send_raw_sendfile(loop, sock, rawf, peer, stats,
+                                        index, start, end)
+            else:
+                await send_raw_mmap(loop, sock, rawf, peer, stats, index,
+                                    start, end)
+        if index:
+            index.close()
+    if pacer and pacer.pfxcounted:
+        log.info("Paced %d messages (%d prefixes) to %s",
+                 pacer.msgcount, pacer.pfxcount, peer.name)
+    elif pacer:
+        log.info("Paced %d messages to %s", pacer.msgcount, peer.name)
+    if convergence:
+        await convergence.wait(peer, start_time, time.time())
+    if args.churn and not peer.rawfile:
+        log.info("Initial load to %s done after %s", peer.name,
+                 str(time.time() - start_time))
+        await send_churn(loop, sock, executor, args, peer, stats, pacer,
+                         convergence, tagger, maxlen)
     stop_time = time.time()
-    log.info("Done sending after %s to %s", str(stop_time - start_time),
-             str((peerip, peerport)))
-
+    log.info(
+        "Done sending after %s to %s: %d messages, %d bytes, %d of %d sends partial, %d updates received",
+        str(stop_time - start_time), peer.name, stats.msgs, stats.bytes,
+        stats.partial, stats.sends, stats.received)
+    if await wait_drained(sock):
+        log.info("Drained after %s to %s (%.3fs after done)",
+                 str(time.time() - start_time), peer.name,
+                 time.time() - stop_time)
+
+
+class ExpectedBlock:
+    # count consecutive subnets of length sublen starting at prefix, with a
+    # bit per subnet recording its presence.
+    def __init__(self, prefix, sublen, nexthop, count):
+        if prefix.version == 4:
+            self.afi = MPBGP_IPV4_AFI
+        else:
+            self.afi = MPBGP_IPV6_AFI
+        self.sublen = sublen
+        nbytes = (sublen + 7) // 8
+        # The NLRI encoding holds the top nbytes of the address, the subnets
+        # are 1 << shift apart in that value.
+        self.shift = 8 * nbytes - sublen
+        self.first = int(prefix.network_address) >> (
+            prefix.max_prefixlen - 8 * nbytes)
+        self.count = count
+        self.nexthop = nexthop.packed
+        self.bits = bytearray((count + 7) // 8)
+        # The subnets that should be present, maintained by the sender when
+        # running closed loop (--converge).
+        self.want = bytearray(len(self.bits))
+
+
+class ExpectedRib:
+    # Expected prefixes given as genrt.get_blocks() style blocks (e.g., from a
+    # genrt.py --expect-file) held as one bitmap per block, a few MB for 10M
+    # prefixes. Also tracks the number of subnets whose presence differs
+    # from what the sender wants (mismatch) for closed loop testing.
+    def __init__(self, blocks, expect_nexthop=None):
+        self.blocks = []
+        self.index = {}
+        self.total = 0
+        self.present = 0
+        self.mismatch = 0
+        self.unexpected = 0
+        self.badnh = 0
+        self.expect_nexthop = expect_nexthop.packed if expect_nexthop else None
+        for prefix, sublen, nexthop, count in blocks:
+            block = ExpectedBlock(prefix, sublen, nexthop, count)
+            self.blocks.append(block)
+            self.index.setdefault((block.afi, block.sublen), []).append(block)
+            self.total += block.count
+        # Sorted starts of the blocks for bisecting.
+        self.starts = {}
+        for key, blocks in self.index.items():
+            blocks.sort(key=lambda x: x.first)
+            self.starts[key] = [x.first for x in blocks]
+
+    def lookup(self, afi, data, offset, nend):
+        # Return the block and index of the NLRI prefix at offset or None.
+        plen = data[offset]
+        blocks = self.index.get((afi, plen))
+        if not blocks:
+            return None, 0
+        top = int.from_bytes(data[offset + 1:nend], "big")
+        i = bisect.bisect_right(self.starts[(afi, plen)], top) - 1
+        if i < 0:
+            return None, 0
+        block = blocks[i]
+        idx = (top - block.first) >> block.shift
+        if idx >= block.count:
+            return None, 0
+        return block, idx
+
+    def announce(self, afi, nexthop, data, offset, end):
+        count = 0
+        while offset < end:
+            nend = offset + 1 + (data[offset] + 7) // 8
+            block, idx = self.lookup(afi, data, offset, nend)
+            offset = nend
+            count += 1
+            if block is None:
+                self.unexpected += 1
+                continue
+            if nexthop != (self.expect_nexthop or block.nexthop):
+                self.badnh += 1
+            bit = 1 << (idx & 7)
+            if not block.bits[idx >> 3] & bit:
+                block.bits[idx >> 3] |= bit
+                self.present += 1
+                self.mismatch += -1 if block.want[idx >> 3] & bit else 1
+        return count
+
+    def withdraw(self, afi, data, offset, end):
+        count = 0
+        while offset < end:
+            nend = offset + 1 + (data[offset] + 7) // 8
+            block, idx = self.lookup(afi, data, offset, nend)
+            offset = nend
+            count += 1
+            if block is None:
+                self.unexpected += 1
+                continue
+            bit = 1 << (idx & 7)
+            if block.bits[idx >> 3] & bit:
+                block.bits[idx >> 3] &= ~bit
+                self.present -= 1
+                self.mismatch += 1 if block.want[idx >> 3] & bit else -1
+        return count
+
+    def set_want_bit(self, block, idx, value):
+        bit = 1 << (idx & 7)
+        want = block.want[idx >> 3]
+        if bool(want & bit) == value:
+            return
+        block.want[idx >> 3] = want ^ bit
+        self.mismatch += -1 if bool(block.bits[idx >> 3] & bit) == value else 1
+
+    def set_want_range(self, block, lo, hi, value):
+        # Set the wanted state of subnets lo to hi of block, a byte at a
+        # time (as big integers) once aligned.
+        while lo < hi and lo & 7:
+            self.set_want_bit(block, lo, value)
+            lo += 1
+        while hi > lo and hi & 7:
+            hi -= 1
+            self.set_want_bit(block, hi, value)
+        if lo >= hi:
+            return
+        a, b = lo >> 3, hi >> 3
+        have = int.from_bytes(block.bits[a:b], "little")
+        want = int.from_bytes(block.want[a:b], "little")
+        new = (1 << (8 * (b - a))) - 1 if value else 0
+        self.mismatch += bin(have ^ new).count("1") - bin(have ^ want).count(
+            "1")
+        block.want[a:b] = (b"\xff" if value else b"\x00") * (b - a)
+
+    def set_want(self, start, count, value):
+        # Set the wanted state of count subnets beginning with subnet start of
+        # the space made of the concatenated blocks, wrapping at its end.
+        pos = start % self.total
+        while count:
+            for block in self.blocks:
+                if pos >= block.count:
+                    pos -= block.count
+                    continue
+                n = min(block.count - pos, count)
+                self.set_want_range(block, pos, pos + n, value)
+                count -= n
+                pos = 0
+                if not count:
+                    break
+
+
+class Histogram:
+    # Counts of values falling under each of the bounds (and over the last).
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.max = 0
+
+    def add(self, value, count=1):
+        self.counts[bisect.bisect_right(self.bounds, value)] += count
+        self.total += count
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        # The upper bound of the bucket holding the pct percentile value (so
+        # only as precise as the bounds), capped by the maximum.
+        want = self.total * pct / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= want:
+                return min(bound, self.max)
+        return self.max
+
+    def over(self, bound):
+        # Number of values at or over bound (which must be one of bounds).
+        return sum(self.counts[self.bounds.index(bound) + 1:])
+
+    def format(self, unit="s"):
+        lines = []
+        low = 0
+        for bound, count in zip(self.bounds + [None], self.counts):
+            if bound is None:
+                lines.append(">= {}{}: {}".format(low, unit, count))
+            else:
+                lines.append("{}{} - {}{}: {}".format(low, unit, bound, unit,
+                                                      count))
+                low = bound
+        return lines
+
+
+# Block convergence latency buckets, the spec's thresholds are 30s and 50s.
+CONVERGE_BOUNDS = [0.1, 0.5, 1, 2, 5, 10, 20, 30, 50]
+# Tagged update latency buckets in ms, 10% apart from 0.1ms to ~20 minutes.
+LATENCY_BOUNDS = [0.1 * 1.1**x for x in range(172)]
+
+
+class Convergence:
+    # Couples a sender and a receiver in one process, the sender marks what
+    # it wants present in the receiver's ExpectedRib and waits until the
+    # receiver has exactly that.
+    def __init__(self, expected):
+        self.expected = expected
+        self.event = asyncio.Event()
+        self.histogram = Histogram(CONVERGE_BOUNDS)
+        self.blockno = 0
+
+    def check(self):
+        if not self.expected.mismatch:
+            self.event.set()
+
+    async def wait(self, peer, start_time, sent_time):
+        # Wait for the block sent from start_time to sent_time to converge.
+        while self.expected.mismatch:
+            self.event.clear()
+            await self.event.wait()
+        now = time.time()
+        self.blockno += 1
+        self.histogram.add(now - start_time)
+        log.info(
+            "CONVERGED block %d from %s after %.3fs (%.3fs after sent), %d of %d over 30s, %d over 50s",
+            self.blockno, peer.name, now - start_time, now - sent_time,
+            self.histogram.over(30), self.histogram.total,
+            self.histogram.over(50))
+        for line in self.histogram.format():
+            log.info("  %s", line)
+
+
+class RibTable:
+    # Prefix to nexthop table built from received UPDATEs. Prefixes are keyed
+    # by their packed NLRI encoding in a table per AFI and map to a small
+    # integer index into the interned nexthops.
+    # If an ExpectedRib is given prefixes are only recorded in its bitmaps
+    # and other prefixes are just counted.
+    def __init__(self, expect_count=0, expect_nexthop=None, expected=None):
+        self.tables = {MPBGP_IPV4_AFI: {}, MPBGP_IPV6_AFI: {}}
+        self.expected = expected
+        self.nexthops = []
+        self.nhindex = {}
+        self.expect_count = expect_count
+        self.expect_nhid = None
+        if expect_nexthop:
+            self.expect_nhid = self.nexthop_id(expect_nexthop.packed)
+        self.updates = 0
+        self.announced = 0
+        self.withdrawn = 0
+        self.badnh = 0
+        self.first_time = None
+        self.last_time = None
+        self.complete_time = None
+        # Send to receive latency (ms) of the prefixes in tagged updates, in
+        # total and since the last stats.
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.ilatency = Histogram(LATENCY_BOUNDS)
+        self.lastseq = None
+        self.reordered = 0
+
+    def __len__(self):
+        if self.expected:
+            return self.expected.present
+        return sum(len(x) for x in self.tables.values())
+
+    def nexthop_id(self, nexthop):
+        try:
+            return self.nhindex[nexthop]
+        except KeyError:
+            nhid = len(self.nexthops)
+            self.nexthops.append(nexthop)
+            self.nhindex[nexthop] = nhid
+            return nhid
+
+    def announce(self, afi, nexthop, data, offset, end):
+        if self.expected:
+            self.announced += self.expected.announce(afi, nexthop, data,
+                                                     offset, end)
+            return
+        nhid = self.nexthop_id(nexthop)
+        table = self.tables[afi]
+        count = 0
+        while offset < end:
+            nend = offset + 1 + (data[offset] + 7) // 8
+            table[data[offset:nend]] = nhid
+            offset = nend
+            count += 1
+        self.announced += count
+        if self.expect_nhid is not None and nhid != self.expect_nhid:
+            self.badnh += count
+
+    def withdraw(self, afi, data, offset, end):
+        if self.expected:
+            self.withdrawn += self.expected.withdraw(afi, data, offset, end)
+            return
+        table = self.tables[afi]
+        while offset < end:
+            nend = offset + 1 + (data[offset] + 7) // 8
+            table.pop(data[offset:nend], None)
+            offset = nend
+            self.withdrawn += 1
+
+    def update(self, msg, now):
+        # Apply the UPDATE message (bytes or memoryview) received at time now.
+        # Parsed from a copy, slicing bytes is cheaper and the prefixes and
+        # nexthops kept need to be copies anyway.
+        msg = bytes(msg)
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.updates += 1
+        announced = self.announced
+        tag = None
+
+        end = len(msg)
+        offset = BGP_HDR_LEN
+        wlen = unpack("!H", msg[offset:offset + 2])[0]
+        offset += 2
+        self.withdraw(MPBGP_IPV4_AFI, msg, offset, offset + wlen)
+        offset += wlen
+        alen = unpack("!H", msg[offset:offset + 2])[0]
+        offset += 2
+        aend = offset + alen
+        nexthop = None
+        while offset < aend:
+            aflags, atype = msg[offset], msg[offset + 1]
+            if aflags & BGPAF_LONGLEN:
+                vlen = unpack("!H", msg[offset + 2:offset + 4])[0]
+                offset += 4
+            else:
+                vlen = msg[offset + 2]
+                offset += 3
+            vend = offset + vlen
+            if atype == BGPAT_NEXTHOP:
+                nexthop = msg[offset:vend]
+            elif atype == BGPAT_MP_REACH_NLRI:
+                afi = unpack("!H", msg[offset:offset + 2])[0]
+                nhlen = msg[offset + 3]
+                # Only the global address if a link-local is also present.
+                nhlen_global = 16 if (afi == MPBGP_IPV6_AFI
+                                      and nhlen == 32) else nhlen
+                # afi, safi, nexthop len, nexthop, reserved
+                self.announce(afi, msg[offset + 4:offset + 4 + nhlen_global],
+                              msg, offset + 4 + nhlen + 1, vend)
+            elif atype == BGPAT_MP_UNREACH_NLRI:
+                afi = unpack("!H", msg[offset:offset + 2])[0]
+                # afi, safi
+                self.withdraw(afi, msg, offset + 3, vend)
+            elif atype == BGPAT_LARGE_COMMUNITY:
+                for coff in range(offset, vend, 12):
+                    if unpack("!L", msg[coff:coff + 4])[0] == genrt.TAG_ADMIN:
+                        tag = unpack("!LL", msg[coff + 4:coff + 12])
+            offset = vend
+        if aend < end:
+            self.announce(MPBGP_IPV4_AFI, nexthop, msg, aend, end)
+        if tag:
+            self.add_latency(tag, now, self.announced - announced)
+
+        if self.expect_count:
+            if len(self) >= self.expect_count:
+                if self.complete_time is None:
+                    self.complete_time = now
+                    return True
+            else:
+                self.complete_time = None
+        return False
+
+    def add_latency(self, tag, now, count):
+        seq, sent = tag
+        # The tag holds the send time in ms modulo 2^32, a send time
+        # (slightly) in the future due to clock differences counts as 0.
+        latency = (int(now * 1000) - sent) & 0xFFFFFFFF
+        if latency >= 0x80000000:
+            latency = 0
+        self.latency.add(latency, count)
+        self.ilatency.add(latency, count)
+        if self.lastseq is not None and seq < self.lastseq:
+            self.reordered += 1
+        self.lastseq = seq
+
+    def latency_summary(self, histogram):
+        return "latency p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+            histogram.percentile(50), histogram.percentile(99),
+            histogram.max)
+
+
+async def receive_stats(table, peer, interval):
+    last_count = 0
     while True:
-        kamsg = make_msg(BGP_MSG_TYPE_KEEPALIVE, b"")
-        sent = sock.send(kamsg)
-        if sent != len(kamsg):
-            log.warning("Failed to send keepalive!")
-            sock.close()
-            sys.exit(1)
-        log.info("Sent KeepAlive to %s sleeping 30s", str((peerip, peerport)))
-        time.sleep(30)
+        await asyncio.sleep(interval)
+        count = table.announced + table.withdrawn
+        if count == last_count:
+            continue
+        if table.expected:
+            log.info(
+                "%s: %d of %d expected prefixes (%d/s), %d unexpected, %d updates, %d bad nexthop",
+                peer.name, len(table), table.expected.total,
+                (count - last_count) / interval, table.expected.unexpected,
+                table.updates, table.expected.badnh)
+        else:
+            log.info("%s: %d prefixes (%d/s), %d updates, %d bad nexthop",
+                     peer.name, len(table), (count - last_count) / interval,
+                     table.updates, table.badnh)
+        if table.ilatency.total:
+            log.info("%s: %d tagged prefixes, %s, %d reordered updates",
+                     peer.name, table.ilatency.total,
+                     table.latency_summary(table.ilatency), table.reordered)
+            table.ilatency = Histogram(LATENCY_BOUNDS)
+        last_count = count
+
+
+async def flush_records(recorder, interval):
+    # Write the recorded messages out every interval seconds, little is then
+    # lost if we are killed outright.
+    while True:
+        await asyncio.sleep(interval)
+        recorder.flush()
+
+
+async def receive(args, peer, convergence=None, recorder=None):
+    # Receive UPDATEs from the peer into a RibTable and report when the
+    # expected prefix count has been reached. If given, the recorder
+    # (genrt.Bgp4mpWriter) records all messages received once established.
+    loop = asyncio.get_event_loop()
+    sock, reader, holdtime, _, _ = await connect(loop, args, peer)
+    recheader = None
+    if recorder:
+        recheader = recorder.header(peer.asn, args.asn, peer.ip,
+                                    ipaddress.ip_address(
+                                        sock.getsockname()[0]))
+    expected = None
+    expect_count = args.expect_count
+    if convergence:
+        expected = convergence.expected
+    elif args.expect_file:
+        with open(args.expect_file) as expfile:
+            expected = ExpectedRib(genrt.read_expected(expfile),
+                                   args.expect_nexthop)
+        log.info("Loaded %d expected prefixes from %s", expected.total,
+                 args.expect_file)
+        expect_count = expected.total
+    table = RibTable(expect_count, args.expect_nexthop, expected)
+
+    async def receiving():
+        while True:
+            msg = await reader.read()
+            now = time.time()
+            if recheader:
+                recorder.write(recheader, msg, now)
+            msgtype = msg[18]
+            if msgtype == BGP_MSG_TYPE_UPDATE:
+                if table.update(msg, now):
+                    log.info(
+                        "COMPLETE %s: %d prefixes at %.3f, %.3f ms after first update",
+                        peer.name, len(table), now,
+                        (now - table.first_time) * 1000)
+                    if table.latency.total:
+                        log.info("COMPLETE %s: %s", peer.name,
+                                 table.latency_summary(table.latency))
+                if convergence:
+                    convergence.check()
+            elif msgtype == BGP_MSG_TYPE_NOTIFICATION:
+                raise ConnectionError("NOTIFICATION received: {}".format(
+                    msg[19:].hex()))
+
+    tasks = [
+        loop.create_task(receiving()),
+        loop.create_task(
+            keepalive(loop, sock, peer, holdtime, reader, asyncio.Lock())),
+        loop.create_task(
+            receive_stats(table, peer, args.stats_interval or 1)),
+    ]
+    try:
+        await run_session(tasks)
+    finally:
+        sock.close()
+
+
+async def run_peers(args, peers):
+    # Drive all the peer sessions concurrently in this process.
+    executor = None
+    if args.generate:
+        executor = concurrent.futures.ProcessPoolExecutor(args.gen_jobs)
+    convergence = None
+    if args.converge:
+        convergence = Convergence(
+            ExpectedRib(
+                genrt.get_blocks(args.generate, 0xFFFFFFFF),
+                args.expect_nexthop))
+    statsfile = None
+    if args.stats_file:
+        # Line buffered appends so processes (-P) can share the file.
+        statsfile = open(args.stats_file, "a", buffering=1)
+    recorder = None
+    if args.record and any(peer.receive for peer in peers):
+        # Unbuffered appends of whole buffers of records so processes (-P)
+        # can share the file.
+        recorder = genrt.Bgp4mpWriter(open(args.record, "ab", buffering=0))
+    loop = asyncio.get_running_loop()
+    sessions = asyncio.gather(
+        *[
+            receive(args, peer, convergence, recorder) if peer.receive else
+            ours(args, peer, executor, convergence, statsfile)
+            for peer in peers
+        ],
+        return_exceptions=True)
+    terminated = False
+
+    def terminate():
+        # SIGTERM (e.g., from timeout(1)) stops the sessions and cleans up
+        # like an interrupt.
+        nonlocal terminated
+        log.info("Terminated, stopping the sessions")
+        terminated = True
+        sessions.cancel()
+
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+    flusher = None
+    if recorder:
+        flusher = loop.create_task(
+            flush_records(recorder, RECORD_FLUSH_INTERVAL))
+    try:
+        results = await sessions
+    except asyncio.CancelledError:
+        if not terminated:
+            raise
+        results = []
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        if flusher:
+            flusher.cancel()
+        if recorder:
+            # Also on interrupt so the buffered records aren't lost.
+            recorder.flush()
+            recorder.outfile.close()
+            log.info("Recorded %d messages to %s", recorder.records,
+                     args.record)
+    if executor:
+        executor.shutdown()
+    if statsfile:
+        statsfile.close()
+    failed = 0
+    for peer, result in zip(peers, results):
+        if isinstance(result, Exception):
+            log.error("Session with %s failed: %s", peer.name, str(result))
+            failed += 1
+    return failed
+
+
+def run_peers_process(args, peers):
+    sys.exit(1 if asyncio.run(run_peers(args, peers)) else 0)
+
+
+def run_procs(args, peers):
+    # Spread the peers over args.procs processes each running its own event
+    # loop so the sessions can use more than one core.
+    procs = []
+    for i in range(args.procs):
+        group = peers[i::args.procs]
+        if not group:
+            continue
+        proc = multiprocessing.Process(
+            target=run_peers_process, args=(args, group))
+        proc.start()
+        procs.append(proc)
+    # Pass SIGTERM on so the processes clean up (see run_peers()).
+    signal.signal(signal.SIGTERM,
+                  lambda *_: [proc.terminate() for proc in procs])
+    failed = 0
+    for proc in procs:
+        proc.join()
+        if proc.exitcode:
+            failed += 1
+    return failed
 
 
 def exabgp(localip, routerid, asn, peerip, peerport, peeras):
@@ -573,15 +2186,185 @@ enhanced_route_refresh = False
 def main():
     parser = argparse.ArgumentParser("BGP injection")
     # parser.add_argument("-a", "--ascii", action="store_true", help="Output ASCII")
-    parser.add_argument("-i", "--input", help="Raw data to send")
+    parser.add_argument(
+        "-i", "--input", help="Raw data to send to peers without a file")
     parser.add_argument("-a", "--asn", default="20", help="BGP AS")
+    parser.add_argument(
+        "-b",
+        "--burst",
+        type=int,
+        default=0,
+        help="Token bucket size for --rate [default: rate/100]")
+    parser.add_argument(
+        "--aspath",
+        help="comma sep list of asnumbers for --generate [default: --asn]")
+    parser.add_argument(
+        "--churn",
+        type=int,
+        default=0,
+        help="After the initial --generate load loop withdrawing and announcing this many prefixes")
+    parser.add_argument(
+        "--converge",
+        action="store_true",
+        help="Only send the next block once the receiver has the previous")
+    parser.add_argument(
+        "--tag",
+        action="store_true",
+        help="Tag --generate updates with a sequence number and send time for -R receivers to measure latency")
+    parser.add_argument(
+        "--churn-cycles",
+        type=int,
+        default=0,
+        help="Number of churn cycles [default: 0 forever]")
+    parser.add_argument(
+        "--churn-interval",
+        type=float,
+        default=0,
+        help="Seconds to wait before each churn cycle [default: 0]")
+    parser.add_argument(
+        "-g",
+        "--generate",
+        help="Generate updates for peers without a file from these space sep PREFIX SUBLEN NEXTHOP triples")
+    parser.add_argument(
+        "--ipv4-mp",
+        action="store_true",
+        help="Generate IPv4 routes in MP_REACH_NLRI rather than with NEXT_HOP")
+    parser.add_argument(
+        "--add-path",
+        type=int,
+        default=0,
+        help="Negotiate sending ADD-PATH, --generate N path ids per prefix")
+    parser.add_argument(
+        "--extended-message",
+        action="store_true",
+        help="Negotiate extended messages (RFC 8654), --generate up to 65535 byte updates")
+    parser.add_argument(
+        "--med",
+        type=int,
+        help="MED to add to --generate routes (raised by 1 per ADD-PATH path)")
+    parser.add_argument(
+        "--local-pref",
+        type=int,
+        help="LOCAL_PREF to add to --generate routes (for iBGP peers)")
+    parser.add_argument(
+        "--communities",
+        type=int,
+        default=0,
+        help="Number of COMMUNITIES to add to --generate routes")
+    parser.add_argument(
+        "--large-communities",
+        type=int,
+        default=0,
+        help="Number of LARGE_COMMUNITY values to add to --generate routes")
+    parser.add_argument(
+        "--afi",
+        action="append",
+        choices=["ipv4", "ipv6"],
+        help="Negotiate unicast for this AFI when sending (repeatable) [default: those generated, else both]")
+    parser.add_argument(
+        "--gen-jobs",
+        type=int,
+        default=1,
+        help="Number of processes generating updates [default: 1]")
+    parser.add_argument(
+        "--max-pack",
+        type=int,
+        default=0xFFFF,
+        help="Maximum number of prefixes per generated update")
+    parser.add_argument(
+        "--max-routes",
+        type=int,
+        default=0xFFFFFFFF,
+        help="Maximum number of prefixes to generate [default: 4 billion]")
+    parser.add_argument(
+        "--root-as-inc",
+        action="store_true",
+        help="increment the root as of generated updates")
+    parser.add_argument(
+        "--root-as-mod",
+        type=int,
+        default=0,
+        help="modulus the incrementing root as")
     parser.add_argument(
         "-l", "--local-ip", default="fc20::1", help="BGP Listen IP")
+    parser.add_argument(
+        "-m",
+        "--send-mode",
+        default="sendfile",
+        choices=["sendfile", "mmap"],
+        help="How to push raw data to the socket [default: sendfile]")
+    parser.add_argument(
+        "--rate",
+        type=int,
+        default=0,
+        help="Pace sending to this many units/s [default: 0 unlimited]")
+    parser.add_argument(
+        "--rate-unit",
+        default="updates",
+        choices=["updates", "prefixes"],
+        help="Unit of --rate and --burst [default: updates]")
+    parser.add_argument(
+        "--msg-range",
+        default=":",
+        help="Only send messages N to M - 1 (N:M, either optional) of raw files, needs their .idx index")
+    parser.add_argument(
+        "--split-raw",
+        action="store_true",
+        help="Split the messages (of --msg-range) of each raw file between the peers sending it, needs its .idx index")
     parser.add_argument(
         "-r", "--router-id", default="10.0.0.20", help="BGP Router ID")
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Raw files are MRT BGP4MP traces whose updates are replayed with their recorded timing")
+    parser.add_argument(
+        "--replay-from",
+        help="Only replay the updates received from this peer address")
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=1,
+        help="Replay speed factor, 0 as fast as possible [default: 1]")
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose logging")
-    parser.add_argument("peers", help="EBGP peer (ip,as)")
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=1,
+        help="Seconds between send rate stats, 0 to disable [default: 1]")
+    parser.add_argument(
+        "--stats-file", help="Also append the send rate stats as JSON lines")
+    parser.add_argument(
+        "--expect-count",
+        type=int,
+        default=0,
+        help="Report completion when receivers hold this many prefixes")
+    parser.add_argument(
+        "-e",
+        "--expect-file",
+        help="Expected RIB index (genrt.py -e) to verify receivers against")
+    parser.add_argument(
+        "--expect-nexthop",
+        help="Count prefixes received with a different nexthop")
+    parser.add_argument(
+        "-R",
+        "--receive",
+        action="append",
+        default=[],
+        help="IBGP peer to receive and verify routes from (ip,as or ip,port,as)")
+    parser.add_argument(
+        "--record",
+        help="Record the messages from receivers to this MRT (BGP4MP_ET) file")
+    parser.add_argument(
+        "-P",
+        "--procs",
+        type=int,
+        default=1,
+        help="Number of processes to spread the peers over [default: 1]")
+    parser.add_argument(
+        "peers",
+        nargs="*",
+        help="EBGP peers (ip,as or ip,port,as or ip,port,as,file)")
     args = parser.parse_args()
 
     if args.verbose:
@@ -592,23 +2375,74 @@ def main():
     logging.basicConfig(
         format='%(asctime)s: %(levelname)s: %(message)s', level=logging.DEBUG)
 
+    peers = [Peer.from_spec(x, args.input) for x in args.peers]
+    peers += [Peer.from_spec(x, None, True) for x in args.receive]
+    if args.generate:
+        args.generate = args.generate.split()
+        if len(args.generate) % 3:
+            parser.error("Generate prefix sublen args must come in triples")
+    if args.churn and not args.generate:
+        parser.error("--churn requires --generate")
+    if args.replay and (args.rate or args.msg_range != ":"
+                        or args.split_raw):
+        parser.error(
+            "--replay can't be used with --rate, --msg-range or --split-raw")
+    if args.split_raw:
+        # Each of the peers sending a raw file sends its share of the
+        # messages, so the file is sent once over all the sessions (and -P
+        # processes).
+        senders = collections.defaultdict(list)
+        for peer in peers:
+            if peer.rawfile and not peer.receive:
+                senders[peer.rawfile].append(peer)
+        for group in senders.values():
+            for part, peer in enumerate(group):
+                peer.share = (part, len(group))
+    if args.converge:
+        if not args.generate or len(args.receive) != 1:
+            parser.error("--converge requires --generate and one receiver")
+        if args.expect_file or args.procs > 1:
+            parser.error("--converge can't be used with -e or -P")
+    for peer in peers:
+        if not peer.rawfile and not peer.receive and not args.generate:
+            parser.error("No raw data for peer {}".format(peer.name))
     try:
-        peerip, peerport, peeras = args.peers.split(",")
+        first, last = args.msg_range.split(":")
+        args.msg_range = (int(first or 0), int(last) if last else None)
     except ValueError:
-        peerport = 179
-        peerip, peeras = args.peers.split(",")
-    peerip = ipaddress.ip_address(peerip)
-    peerport = int(peerport)
-    peeras = int(peeras)
-    routerid = ipaddress.ip_address(args.router_id)
-    localip = ipaddress.ip_address(args.local_ip)
-    localas = int(args.asn)
-
-    # ryu(args.router_id, localas, peerip, peerport, peeras)
-    # yabgp(args.router_id, localas, peerip, peerport, peeras)
-    # exabgp(localip, args.router_id, localas, peerip, peerport, peeras)
-    ours(localip, routerid, localas, peerip, peerport, peeras, args.input)
-
+        parser.error("--msg-range must be N:M")
+    args.router_id = ipaddress.ip_address(args.router_id)
+    args.local_ip = ipaddress.ip_address(args.local_ip)
+    args.asn = int(args.asn)
+    args.aspath = (args.aspath or str(args.asn)).split(",")
+    if args.expect_nexthop:
+        args.expect_nexthop = ipaddress.ip_address(args.expect_nexthop)
+    if args.replay_from:
+        args.replay_from = ipaddress.ip_address(args.replay_from)
+    if args.afi:
+        afis = set(args.afi)
+    elif args.generate:
+        afis = set("ipv{}".format(block[0].version)
+                   for block in genrt.get_blocks(args.generate, 0xFFFFFFFF))
+    else:
+        afis = set(AFI_NAMES.values())
+    args.afis = [x for x in AFI_NAMES if AFI_NAMES[x] in afis]
+    args.profile = genrt.get_profile(args.med, args.local_pref,
+                                     args.communities, args.large_communities)
+    if args.record:
+        # Truncate once here, the (-P) processes append to it.
+        open(args.record, "wb").close()
+
+    # peer = peers[0]
+    # ryu(args.router_id, args.asn, peer.ip, peer.port, peer.asn)
+    # yabgp(args.router_id, args.asn, peer.ip, peer.port, peer.asn)
+    # exabgp(args.local_ip, args.router_id, args.asn, peer.ip, peer.port, peer.asn)
+    if args.procs > 1:
+        failed = run_procs(args, peers)
+    else:
+        failed = asyncio.run(run_peers(args, peers))
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
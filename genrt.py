@@ -4,9 +4,17 @@
 # July 20 2018, Christian E. Hopps <chopps@gmail.com>
 #
 import argparse
+import array
+import bisect
+import contextlib
 import io
+import itertools
 import ipaddress
 import logging
+import mmap
+import multiprocessing
+import os
+import random
 import time
 import struct
 import sys
@@ -69,23 +77,18 @@ BGPAT_ASPATH_ST_SEQ = 2
 BGP_ASPATH_VALUE_20 = b"\x40\x02\x06\x02\x01\x00\x00\x00\x14"
 
 BGPAT_NEXTHOP = 3
+BGPAT_MED = 4
+BGPAT_LOCAL_PREF = 5
+BGPAT_COMMUNITIES = 8
 BGPAT_MP_REACH_NLRI = 14
 BGPAT_MP_UNREACH_NLRI = 15
+BGPAT_LARGE_COMMUNITY = 32
 
 MPBGP_IPV4_AFI = 1
 MPBGP_IPV6_AFI = 2
 MPBGP_UNICAST_SAFI = 1
 
-
-def packprefix(prefix):
-    packed = prefix.network_address.packed
-    plen = prefix.prefixlen
-    olen, blen = plen // 8, plen % 8
-    if blen:
-        p = packed[0:olen + 1]
-    else:
-        p = packed[0:olen]
-    return bytes((plen, )) + p
+AS_TRANS = 23456
 
 
 # ----------
@@ -133,7 +136,12 @@ def packprefix(prefix):
 # | Network Layer Reachability Information (variable)       |
 # +---------------------------------------------------------+
 
-BGP_MAX_UPDATE_LEN = 4096 - 19
+# The maximum message length, and with the extended message capability
+# (RFC 8654) that of any message but OPEN and KEEPALIVE.
+BGP_MAX_MSG_LEN = 4096
+BGP_EXT_MAX_MSG_LEN = 65535
+BGP_MAX_UPDATE_LEN = BGP_MAX_MSG_LEN - 19
+BGP_MARKER = bytes((0xff, )) * 16
 
 
 def make_msg(typ, data):
@@ -158,7 +166,52 @@ def get_aspath_attr(aslist):
     return aspath
 
 
-def get_attrs(aslist, nexthop):
+# The latency tag is a large community with this (private use) global
+# administrator, the sender fills in the local data parts with a sequence
+# number and the send time in ms.
+TAG_ADMIN = 4200000000
+
+
+def get_tag_offset(aslist, nexthop, ipv4mp=False, profile=None):
+    # Return the offset of the tag sequence number in an update for aslist,
+    # the tag is the first large community of the last attribute (see
+    # get_attrs()). Classic IPv4 updates carry their NLRI after the
+    # attributes so the offset is from the start of the update, the others
+    # carry the large communities after MP_REACH_NLRI and its NLRI so the
+    # offset is negative, from the end of the update.
+    nlarge = 1 + (profile[3] if profile else 0)
+    attrs, mpattr, _ = get_attrs(aslist, nexthop, True, ipv4mp, profile)
+    if mpattr:
+        return 4 - 12 * nlarge
+    return 23 + len(attrs) - 12 * nlarge + 4
+
+
+def make_attr(flags, atype, value):
+    # Return a path attribute, with an extended length if needed.
+    if len(value) > 255:
+        return struct.pack("!BBH", flags | BGPAF_LONGLEN, atype,
+                           len(value)) + value
+    return struct.pack("!BBB", flags, atype, len(value)) + value
+
+
+# An attribute profile adds attributes to make updates costlier to parse,
+# the tuple (MED, LOCAL_PREF, number of communities, number of large
+# communities), None omitting MED or LOCAL_PREF. The communities are
+# numbered from 1 under the (low 16 bits of the) first AS of the path.
+def get_profile(med=None, localpref=None, communities=0, large=0):
+    if med is None and localpref is None and not communities and not large:
+        return None
+    return (med, localpref, communities, large)
+
+
+def get_attrs(aslist, nexthop, tag=False, ipv4mp=False, profile=None):
+    # Return the attributes preceding MP_REACH_NLRI, MP_REACH_NLRI (lacking
+    # its NLRI) and the attributes following it, all in type order. With
+    # ipv4mp IPv4 routes are sent in MP_REACH_NLRI (AFI 1) rather than with
+    # NEXT_HOP in the classic NLRI field, with neither MP_REACH_NLRI nor the
+    # attributes following it are used. The profile attributes (see
+    # get_profile()) follow the NEXT_HOP.
+    med, localpref, ncomm, nlarge = profile or (None, None, 0, 0)
     # ------
     # Origin
     # ------
@@ -169,41 +222,217 @@ def get_attrs(aslist, nexthop):
     # -------
     attrs += get_aspath_attr(aslist)
 
-    if nexthop.version == 4:
+    classic = nexthop.version == 4 and not ipv4mp
+    if classic:
         # --------
         # Next-Hop
         # --------
         attrs += bytes((BGPAF_TRANS, BGPAT_NEXTHOP, len(nexthop.packed)))
         assert len(nexthop.packed) == 4
         attrs += nexthop.packed
-        mpattr = b""
-    else:
-        # Now add IPv6 multiprotocol attr
-        mpattr = bytes((
-            BGPAF_OPTIONAL | BGPAF_LONGLEN,
-            BGPAT_MP_REACH_NLRI,
-        ))
-        # pad for len, afi, safi, nhlen, nh
-        mpattr += struct.pack("!HHBB", 0, MPBGP_IPV6_AFI, MPBGP_UNICAST_SAFI,
-                              len(nexthop.packed))
-        mpattr += nexthop.packed
-        # 0 SNPA
-        mpattr += b"\x00"
-
-    return attrs, mpattr
 
-
-def get_update_header(aslist, nexthop):
+    # -------
+    # Profile
+    # -------
+    if med is not None:
+        attrs += make_attr(BGPAF_OPTIONAL, BGPAT_MED, struct.pack("!L", med))
+    if localpref is not None:
+        attrs += make_attr(BGPAF_TRANS, BGPAT_LOCAL_PREF,
+                           struct.pack("!L", localpref))
+    if ncomm:
+        attrs += make_attr(
+            BGPAF_OPTIONAL | BGPAF_TRANS, BGPAT_COMMUNITIES,
+            b"".join(
+                struct.pack("!HH", aslist[0] & 0xFFFF, x)
+                for x in range(1, ncomm + 1)))
+
+    # ---------------
+    # Large Community
+    # ---------------
+    # The tag (if any) comes first followed by the profile large
+    # communities, there can only be one attribute of a type.
+    large = struct.pack("!LLL", TAG_ADMIN, 0, 0) if tag else b""
+    large += b"".join(
+        struct.pack("!LLL", aslist[0], 1, x) for x in range(1, nlarge + 1))
+    if large:
+        large = make_attr(BGPAF_OPTIONAL | BGPAF_TRANS, BGPAT_LARGE_COMMUNITY,
+                          large)
+
+    if classic:
+        return attrs + large, b"", b""
+
+    # Now add multiprotocol attr
+    mpattr = bytes((
+        BGPAF_OPTIONAL | BGPAF_LONGLEN,
+        BGPAT_MP_REACH_NLRI,
+    ))
+    afi = MPBGP_IPV4_AFI if nexthop.version == 4 else MPBGP_IPV6_AFI
+    # pad for len, afi, safi, nhlen, nh
+    mpattr += struct.pack("!HHBB", 0, afi, MPBGP_UNICAST_SAFI,
+                          len(nexthop.packed))
+    mpattr += nexthop.packed
+    # 0 SNPA
+    mpattr += b"\x00"
+
+    return attrs, mpattr, large
+
+
+def get_update_header(aslist, nexthop, tag=False, ipv4mp=False, profile=None):
     # No withdraw, add attributes
-    attrs, mpattr = get_attrs(aslist, nexthop)
-    alen = len(attrs) + len(mpattr)
+    attrs, mpattr, trailer = get_attrs(aslist, nexthop, tag, ipv4mp, profile)
+    alen = len(attrs) + len(mpattr) + len(trailer)
     # data = struct.pack("!HH", 0, len(attrs)) + attrs
-    return attrs, mpattr, 4096 - 23 - alen
+    return attrs, mpattr, trailer, BGP_MAX_MSG_LEN - 23 - alen
+
+
+def pack_nlri(prefix, sublen, start, count, pathid=0):
+    # Return the packed NLRI of count subnets of length sublen of prefix
+    # beginning with subnet number start. Each encoded prefix is the length
+    # octet followed by the top nbytes of the address, consecutive subnets
+    # are simply step apart when taken as integers so we never create
+    # ipaddress objects. A non zero pathid precedes each prefix as its
+    # ADD-PATH path identifier.
+    nbytes = (sublen + 7) // 8
+    width = nbytes + (5 if pathid else 1)
+    step = 1 << (8 * nbytes - sublen)
+    first = (pathid << (8 * nbytes + 8)) + (sublen << (8 * nbytes)) + \
+        (int(prefix.network_address) >> (prefix.max_prefixlen - 8 * nbytes)) + \
+        start * step
+    return b"".join([
+        x.to_bytes(width, "big")
+        for x in range(first, first + count * step, step)
+    ])
+
+
+# Number of prefixes generated in one go (per worker with --jobs).
+CHUNK_ROUTES = 0x10000
+
+
+def make_update_template(attrs, mpattr, nlrilen, trailer=b""):
+    # Return the BGP header, attributes and MP_REACH_NLRI (if any, lacking
+    # its NLRI) of an update carrying nlrilen bytes of NLRI followed by the
+    # trailer attributes (only with MP_REACH_NLRI).
+    # BGP Header: marker[16], len[2], type[1]
+    if mpattr:
+        alen = len(attrs) + len(mpattr) + nlrilen + len(trailer)
+        mlen = alen
+    else:
+        alen = len(attrs)
+        mlen = alen + nlrilen
+    # message len is + 16 (marker) + 2 (len) + 1 (type) + 2 (withlen) + 2 (attrlen)
+    template = bytearray(BGP_MARKER)
+    template += struct.pack("!HBHH", mlen + 23, BGP_MSGTYPE_UPDATE, 0,
+                            alen)  # 0 withdraw, attrlen
+    template += attrs
+    if mpattr:
+        # mpattr 1 flags, 1 type, 2 length of mpattr value + nlri, rest of mpattr and nrli
+        template += mpattr
+        struct.pack_into("!H", template, len(template) - len(mpattr) + 2,
+                         len(mpattr) - 4 + nlrilen)
+    return template
+
+
+def get_update_template(aslist,
+                        nexthop,
+                        nlrilen,
+                        tag=False,
+                        ipv4mp=False,
+                        profile=None):
+    # Return the BGP header, attributes and MP_REACH_NLRI (if any) of an
+    # update carrying nlrilen bytes of NLRI, the attributes following the
+    # NLRI and the offset of the root (last) AS in it so it can be patched
+    # in place.
+    attrs, mpattr, trailer, _ = get_update_header(aslist, nexthop, tag,
+                                                  ipv4mp, profile)
+    template = make_update_template(attrs, mpattr, nlrilen, trailer)
+    # origin, aspath flags, type, len, segment type, count, ASes
+    asoff = 23 + len(BGP_ORIGIN_VALUE_IGP) + 5 + 4 * (len(aslist) - 1)
+    return bytes(template), trailer, asoff
+
+
+def get_withdraw_template(version, nlrilen, ipv4mp=False):
+    # Return the BGP header and attributes preceding, and the octets
+    # following, the NLRI of an update withdrawing nlrilen bytes of NLRI.
+    if version == 4 and not ipv4mp:
+        # Withdrawn routes length, routes, then a 0 attribute length.
+        template = BGP_MARKER + struct.pack("!HBH", nlrilen + 23,
+                                            BGP_MSGTYPE_UPDATE, nlrilen)
+        return template, b"\x00\x00"
+    # 0 withdraw, attrlen, MP_UNREACH_NLRI flags, type, length, afi, safi
+    alen = 7 + nlrilen
+    template = BGP_MARKER + struct.pack(
+        "!HBHHBBHHB", alen + 23, BGP_MSGTYPE_UPDATE, 0, alen,
+        BGPAF_OPTIONAL | BGPAF_LONGLEN, BGPAT_MP_UNREACH_NLRI, 3 + nlrilen,
+        MPBGP_IPV4_AFI if version == 4 else MPBGP_IPV6_AFI,
+        MPBGP_UNICAST_SAFI)
+    return template, b""
+
+
+def get_chunk_template(aslist,
+                       nexthop,
+                       withdraw,
+                       nlrilen,
+                       tag=False,
+                       ipv4mp=False,
+                       profile=None):
+    # Return the octets before and after the NLRI of a chunk's update and
+    # the offset of the root AS (None for withdraws).
+    if withdraw:
+        template, trailer = get_withdraw_template(nexthop.version, nlrilen,
+                                                  ipv4mp)
+        return template, trailer, None
+    return get_update_template(aslist, nexthop, nlrilen, tag, ipv4mp,
+                               profile)
+
+
+def next_root_as(asn, rootas, modroot):
+    asn += 1
+    if modroot:
+        asn = rootas + (rootas - asn) % modroot
+    return asn
+
+
+def gen_update_chunk(chunk):
+    # Generate the updates for count subnets starting at subnet start, which
+    # is the first subnet of an update. The root AS of the first update is
+    # the last element of aslist. Run in the worker processes with --jobs.
+    #
+    # Only the root AS differs between the updates so the header and
+    # attributes are built once and copied into a preallocated buffer
+    # patching the root AS, only the final short update needs another.
+    (prefix, sublen, nexthop, npack, start, count, aslist, rootas, incroot,
+     modroot, withdraw, tag, ipv4mp, profile, pathid) = chunk
+    plen = (5 if pathid else 1) + (sublen + 7) // 8
+    nupdates = (count + npack - 1) // npack
+    template, trailer, asoff = get_chunk_template(aslist, nexthop, withdraw,
+                                                  npack * plen, tag, ipv4mp,
+                                                  profile)
+    tlen = len(template)
+    trlen = len(trailer)
+    outbuf = bytearray(nupdates * (tlen + trlen) + count * plen)
+    nlri = memoryview(pack_nlri(prefix, sublen, start, count, pathid))
+    nlrilen = npack * plen
+    asn = aslist[-1]
+    pos = 0
+    for npos in range(0, count * plen, nlrilen):
+        if npos + nlrilen > len(nlri):
+            nlrilen = len(nlri) - npos
+            template, trailer, asoff = get_chunk_template(
+                aslist, nexthop, withdraw, nlrilen, tag, ipv4mp, profile)
+        outbuf[pos:pos + tlen] = template
+        if incroot and asoff:
+            # Possibly update the AS PATH
+            struct.pack_into("!L", outbuf, pos + asoff, asn)
+            asn = next_root_as(asn, rootas, modroot)
+        pos += tlen
+        outbuf[pos:pos + nlrilen] = nlri[npos:npos + nlrilen]
+        pos += nlrilen
+        outbuf[pos:pos + trlen] = trailer
+        pos += trlen
+    return outbuf
 
 
-# Pack as many NRLI into a single update as possible
-def gen_routes_update(  # pylint: disable=R0913,R0914
-        outfile,  # pylint: disable=R0913,R0914
+def get_update_chunks(  # pylint: disable=R0913,R0914
         prefix,  # pylint: disable=R0913,R0914
         sublen,  # pylint: disable=R0913,R0914
         nexthop,  # pylint: disable=R0913,R0914
@@ -211,76 +440,197 @@ def gen_routes_update(  # pylint: disable=R0913,R0914
         maxroute,  # pylint: disable=R0913,R0914
         aspath,  # pylint: disable=R0913,R0914
         incroot,  # pylint: disable=R0913,R0914
-        modroot):  # pylint: disable=R0913,R0914
-    # print(prefix, sublen, seqno)
-
-    def write_update(attrs, mpattr, nlri):
-        # BGP Header: marker[16], len[2], type[1]
-        alen = len(attrs)
-        if mpattr:
-            alen = len(attrs) + len(mpattr) + len(nlri)
-            mlen = alen
-        else:
-            alen = len(attrs)
-            mlen = alen + len(nlri)
-        # message len is + 16 (marker) + 2 (len) + 1 (type) + 2 (withlen) + 2 (attrlen)
-        msghdr = bytes((0xff, )) * 16 + \
-            struct.pack("!HB", mlen + 23, BGP_MSGTYPE_UPDATE) + \
-            struct.pack("!HH", 0, alen) # 0 withdraw, attrlen
-        # header
-        outfile.write(msghdr)
-        # attrs
-        outfile.write(attrs)
-        if mpattr:
-            # mpattr 1 flags, 1 type, 2 length of mpattr value + nlri, rest of mpattr and nrli
-            mplen = len(mpattr[4:]) + len(nlri)
-            mpattr = mpattr[:2] + struct.pack("!H", mplen) + mpattr[4:]
-            outfile.write(mpattr)
-        outfile.write(nlri)
-
+        modroot,  # pylint: disable=R0913,R0914
+        first=0,  # pylint: disable=R0913,R0914
+        withdraw=False,  # pylint: disable=R0913,R0914
+        tag=False,  # pylint: disable=R0913,R0914
+        ipv4mp=False,  # pylint: disable=R0913,R0914
+        profile=None,  # pylint: disable=R0913,R0914
+        addpath=0,  # pylint: disable=R0913,R0914
+        maxlen=BGP_MAX_MSG_LEN):  # pylint: disable=R0913,R0914
+    # Return the gen_update_chunk() arguments generating the updates (or
+    # withdraws) for the subnets of prefix beginning with subnet first split
+    # into chunks of whole updates, walking the root AS sequence so each
+    # chunk starts with the AS path it would have had serially. With tag the
+    # updates carry a zeroed latency tag (see get_tag_offset()), with ipv4mp
+    # IPv4 routes use MP_REACH_NLRI/MP_UNREACH_NLRI and profile adds
+    # attributes (see get_profile()). With addpath the subnets are sent
+    # addpath times, each pass with its ADD-PATH path identifier (from 1)
+    # and its MED (if any) raised by one so the paths differ. The updates
+    # are at most maxlen bytes long.
     aslist = [int(x) for x in aspath if x]
     rootas = aslist[-1]
 
-    attrs, mpattr, remain = get_update_header(aslist, nexthop)
-    nlri = b""
-    ucount = 0
-    mcount = 0
-    count = 0
-
-    for rprefix in prefix.subnets(new_prefix=sublen):
-        if (count % 10000) == 0:
-            print("{} len {} routes: {}".format(prefix, sublen, count), file=sys.stderr, end='\r')
-
-        p = packprefix(rprefix)
-        plen = len(p)
-
-        if plen > remain or mcount == maxpack:
-            write_update(attrs, mpattr, nlri)
-            ucount += 1
-            # Possibly update the AS PATH
+    # All the prefixes are the same length so the number that fit in an
+    # update is fixed (the AS path length does not change).
+    template, trailer, _ = get_chunk_template(aslist, nexthop, withdraw, 0,
+                                              tag, ipv4mp, profile)
+    remain = maxlen - len(template) - len(trailer)
+    plen = (5 if addpath else 1) + (sublen + 7) // 8
+    assert remain >= plen, "attributes leave no room for NLRI"
+    npack = max(1, min(maxpack, remain // plen))
+    count = min((1 << (sublen - prefix.prefixlen)) - first, maxroute)
+
+    chunks = []
+    chunkroutes = max(1, CHUNK_ROUTES // npack) * npack
+    asn = rootas
+    for pathid in range(1, addpath + 1) if addpath else (0, ):
+        pprofile = profile
+        if profile and profile[0] is not None and pathid:
+            pprofile = (profile[0] + pathid - 1, ) + profile[1:]
+        for start in range(first, first + count, chunkroutes):
+            ccount = min(chunkroutes, first + count - start)
+            chunks.append((prefix, sublen, nexthop, npack, start, ccount,
+                           aslist[:-1] + [asn], rootas, incroot, modroot,
+                           withdraw, tag, ipv4mp, pprofile, pathid))
             if incroot:
-                aslist[-1] += 1
-                if modroot:
-                    aslist[-1] = rootas + (rootas - aslist[-1]) % modroot
-            attrs, mpattr, remain = get_update_header(aslist, nexthop)
-            nlri = b""
-            mcount = 0
-
-        nlri += p
-        remain -= plen
-        count += 1
-        mcount += 1
-
-        if count == maxroute:
-            break
+                for _ in range((ccount + npack - 1) // npack):
+                    asn = next_root_as(asn, rootas, modroot)
+    return chunks
 
-    print("{} len {} routes: {}".format(prefix, sublen, count), file=sys.stderr)
 
-    if mcount:
-        write_update(attrs, mpattr, nlri)
-        ucount += 1
-
-    return ucount, count
+# Pack as many NRLI into a single update as possible
+def gen_routes_update(  # pylint: disable=R0913,R0914
+        outfile,  # pylint: disable=R0913,R0914
+        prefix,  # pylint: disable=R0913,R0914
+        sublen,  # pylint: disable=R0913,R0914
+        nexthop,  # pylint: disable=R0913,R0914
+        maxpack,  # pylint: disable=R0913,R0914
+        maxroute,  # pylint: disable=R0913,R0914
+        aspath,  # pylint: disable=R0913,R0914
+        incroot,  # pylint: disable=R0913,R0914
+        modroot,  # pylint: disable=R0913,R0914
+        pool=None,  # pylint: disable=R0913,R0914
+        withdraw=False,  # pylint: disable=R0913,R0914
+        idxfile=None,  # pylint: disable=R0913,R0914
+        ipv4mp=False,  # pylint: disable=R0913,R0914
+        profile=None,  # pylint: disable=R0913,R0914
+        addpath=0,  # pylint: disable=R0913,R0914
+        maxlen=BGP_MAX_MSG_LEN):  # pylint: disable=R0913,R0914
+    # print(prefix, sublen, seqno)
+    chunklist = get_update_chunks(prefix, sublen, nexthop, maxpack, maxroute,
+                                  aspath, incroot, modroot, 0, withdraw,
+                                  ipv4mp=ipv4mp, profile=profile,
+                                  addpath=addpath, maxlen=maxlen)
+    if pool:
+        results = pool.imap(gen_update_chunk, chunklist)
+    else:
+        results = map(gen_update_chunk, chunklist)
+    done = 0
+    ucount = 0
+    for outbuf, chunk in zip(results, chunklist):
+        npack, ccount = chunk[3], chunk[5]
+        if idxfile:
+            idxfile.write(index_chunk(outbuf, npack, ccount, outfile.tell()))
+        outfile.write(outbuf)
+        ucount += (ccount + npack - 1) // npack
+        done += ccount
+        print("{} len {} routes: {}".format(prefix, sublen, done), file=sys.stderr, end='\r')
+
+    print("{} len {} routes: {}".format(prefix, sublen, done), file=sys.stderr)
+
+    return ucount, done
+
+
+# ----------------
+# Raw Update Index
+# ----------------
+
+# A raw update file FILE can have a sidecar index FILE.idx so it can be
+# sliced without walking the message headers: IDX_MAGIC followed by a
+# fixed size record per message giving its offset, length and the number
+# of prefixes it announces or withdraws.
+IDX_MAGIC = b"BGPRAWIX"
+IDX_RECORD = struct.Struct("!QHH")
+
+
+def get_index_path(rawpath):
+    return rawpath + ".idx"
+
+
+def index_chunk(outbuf, npack, count, base):
+    # Return the index records of the updates of count prefixes, npack per
+    # update, in outbuf which will be written at offset base.
+    records = bytearray()
+    offset = 0
+    while offset < len(outbuf):
+        mlen = struct.unpack_from("!H", outbuf, offset + 16)[0]
+        records += IDX_RECORD.pack(base + offset, mlen, min(npack, count))
+        count -= npack
+        offset += mlen
+    return records
+
+
+class RawIndex:
+    # The index of a raw update file mapped read only, indexing gives the
+    # (offset, length, prefix count) of a message. The message offsets and
+    # cumulative prefix counts are also unpacked up front, by slicing arrays
+    # of the records' words rather than record by record, so finding
+    # messages and counting the prefixes of a range are cheap.
+    def __init__(self, idxfile):
+        self.mm = mmap.mmap(idxfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(IDX_MAGIC)] != IDX_MAGIC:
+            self.mm.close()
+            raise ValueError("{} is not a raw update index".format(
+                idxfile.name))
+        self.count = (len(self.mm) - len(IDX_MAGIC)) // IDX_RECORD.size
+        records = self.mm[len(IDX_MAGIC):len(IDX_MAGIC) +
+                          self.count * IDX_RECORD.size]
+        # Each record is the words offset high, offset low, length and
+        # prefix count (the last two halves).
+        words = array.array("I", records)
+        halves = array.array("H", records)
+        assert words.itemsize == 4 and halves.itemsize == 2
+        if sys.byteorder == "little":
+            words.byteswap()
+            halves.byteswap()
+        high, low = words[0::3], words[1::3]
+        # The offset of the count'th message is the end of the file.
+        end = ((high[-1] << 32) + low[-1] + halves[-2]) if self.count else 0
+        if end >> 32:
+            self.offsets = array.array(
+                "Q", ((x << 32) | y for x, y in zip(high, low)))
+        else:
+            # The offsets only ever increase, all their high words are 0.
+            self.offsets = low
+        self.offsets.append(end)
+        self.lengths = halves[4::6]
+        self.counts = halves[5::6]
+        self.cumcounts = array.array(
+            "Q", itertools.accumulate(self.counts, initial=0))
+
+    @classmethod
+    def open(cls, rawpath):
+        # Return the index of rawpath or None if it has none.
+        try:
+            with open(get_index_path(rawpath), "rb") as idxfile:
+                return cls(idxfile)
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, msgno):
+        if not 0 <= msgno < self.count:
+            raise IndexError(msgno)
+        return IDX_RECORD.unpack_from(self.mm,
+                                      len(IDX_MAGIC) + msgno * IDX_RECORD.size)
+
+    def offset(self, msgno):
+        # The offset of message msgno, the end of the file for the count.
+        return self.offsets[msgno]
+
+    def find(self, offset):
+        # Return the number of the first message starting at or after offset.
+        return bisect.bisect_left(self.offsets, offset, 0, self.count)
+
+    def prefixes(self, first, last):
+        # The number of prefixes in messages first to last - 1.
+        return self.cumcounts[last] - self.cumcounts[first]
 
 
 # ---------
@@ -300,8 +650,9 @@ def gen_routes_update(  # pylint: disable=R0913,R0914
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 
-def mrtencode(outfile, typ, subtype, value):
-    ts = int(time.time())
+def mrtencode(outfile, typ, subtype, value, ts=None):
+    if ts is None:
+        ts = int(time.time())
     vlen = len(value)
     # print("MRT Record: type {} subtype {} len {}".format(typ, subtype, vlen))
     outfile.write(struct.pack("!LHHL", ts, typ, subtype, vlen))
@@ -397,17 +748,12 @@ def genpeers(outfile, peers):
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 
-def genroute(outfile, prefix, nexthop, aslist, seqno):
-    #print("Adding {} via {} seqno {}".format(prefix, nexthop, seqno))
-
-    routefile = io.BytesIO()
-    routefile.write(struct.pack("!L", seqno))
-    routefile.write(packprefix(prefix))
-    # 1 entry
-    routefile.write(b"\x00\x01")
-    # 1st peer, originated now
-    origtime = int(time.time())
-    routefile.write(struct.pack("!HL", 0, origtime))
+def get_rib_template(prefix, sublen, nexthop, aslist, ts):
+    # Return the MRT record of a RIB entry (one entry from the first peer,
+    # originated at ts) for a subnet of length sublen of prefix, and the
+    # offset of the root AS in it. The sequence number (at 12) and the prefix
+    # (at 16) are left 0 to be patched in place.
+    nbytes = (sublen + 7) // 8
 
     # Origin
     attrs = BGP_ORIGIN_VALUE_IGP
@@ -428,21 +774,50 @@ def genroute(outfile, prefix, nexthop, aslist, seqno):
         # 0 SNPA
         attrs += b"\x00"
 
-    routefile.write(struct.pack("!H", len(attrs)))
-    routefile.write(attrs)
-
     if prefix.version == 4:
         subtype = TD_STYPE_RIB_IPV4_UNICAST
     else:
         subtype = TD_STYPE_RIB_IPV6_UNICAST
 
-    mrtencode(outfile, MRT_TYPE_TABLE_DUMP_V2, subtype, routefile.getvalue())
+    # seqno, prefix, 1 entry: 1st peer, originated ts
+    value = struct.pack("!L", 0) + bytes(1 + nbytes)
+    value += struct.pack("!HHLH", 1, 0, ts, len(attrs)) + attrs
+    template = struct.pack("!LHHL", ts, MRT_TYPE_TABLE_DUMP_V2, subtype,
+                           len(value)) + value
+    # mrt header, seqno, prefix, entry header, origin, aspath header, ASes
+    asoff = 12 + 4 + 1 + nbytes + 10 + len(BGP_ORIGIN_VALUE_IGP) + 5 + 4 * (
+        len(aslist) - 1)
+    return template, asoff
+
+
+def gen_rib_chunk(chunk):
+    # Generate the MRT RIB records for count subnets starting at subnet
+    # start. Like gen_update_chunk() the record is built once and copied
+    # patching the sequence number, prefix and root AS. The root AS moves
+    # on after the first subnet and every maxpack'th one after it.
+    (prefix, sublen, nexthop, start, count, seqno, aslist, rootas, incroot,
+     modroot, maxpack, ts) = chunk
+    plen = 1 + (sublen + 7) // 8
+    template, asoff = get_rib_template(prefix, sublen, nexthop, aslist, ts)
+    reclen = len(template)
+    outbuf = bytearray(template * count)
+    nlri = pack_nlri(prefix, sublen, start, count)
+    asn = aslist[-1]
+    pos = 0
+    for npos in range(0, count * plen, plen):
+        struct.pack_into("!L", outbuf, pos + 12, seqno)
+        seqno = (seqno + 1) & 0xFFFFFFFF
+        outbuf[pos + 16:pos + 16 + plen] = nlri[npos:npos + plen]
+        if incroot:
+            struct.pack_into("!L", outbuf, pos + asoff, asn)
+            if maxpack < 2 or start % maxpack == 0:
+                asn = next_root_as(asn, rootas, modroot)
+            start += 1
+        pos += reclen
+    return outbuf
 
 
-def genroutes(  # pylint: disable=R0913,R0914
-        tablefile,  # pylint: disable=R0913,R0914
-        fmtfile,  # pylint: disable=R0913,R0914
-        fmt, # pylint: disable=R0913,R0914
+def get_rib_chunks(  # pylint: disable=R0913,R0914
         prefix,  # pylint: disable=R0913,R0914
         sublen,  # pylint: disable=R0913,R0914
         nexthop,  # pylint: disable=R0913,R0914
@@ -451,38 +826,518 @@ def genroutes(  # pylint: disable=R0913,R0914
         maxroute,  # pylint: disable=R0913,R0914
         aspath,  # pylint: disable=R0913,R0914
         incroot,  # pylint: disable=R0913,R0914
-        modroot):  # pylint: disable=R0913,R0914
-
+        modroot,  # pylint: disable=R0913,R0914
+        ts):  # pylint: disable=R0913,R0914
+    # Return the gen_rib_chunk() arguments generating the same records as
+    # genroutes() does one by one, and the sequence number following them.
     aslist = [int(x) for x in aspath if x]
     rootas = aslist[-1]
 
-    for count, rprefix in enumerate(prefix.subnets(new_prefix=sublen)):
-        if (seqno % 10000) == 0:
-            print("{} len {} routes: {}".format(prefix, sublen, count), file=sys.stderr, end='\r')
-
-        if tablefile:
-            genroute(tablefile, rprefix, nexthop, aslist, seqno)
-
-        if fmtfile:
-            fmtfile.write(fmt.format(prefix=rprefix, nexthop=nexthop) + "\n")
-
+    # genroutes() stops after the subnet numbered maxroute, not announcing
+    # the next sequence number.
+    count = min(1 << (sublen - prefix.prefixlen), maxroute + 1)
+    if count == maxroute + 1:
+        nextseqno = (seqno + count - 1) & 0xFFFFFFFF
+    else:
+        nextseqno = (seqno + count) & 0xFFFFFFFF
+
+    chunks = []
+    asn = rootas
+    for start in range(0, count, CHUNK_ROUTES):
+        ccount = min(CHUNK_ROUTES, count - start)
+        chunks.append((prefix, sublen, nexthop, start, ccount,
+                       (seqno + start) & 0xFFFFFFFF, aslist[:-1] + [asn],
+                       rootas, incroot, modroot, maxpack, ts))
         if incroot:
-            # Max Pack tells us when to increment we allow maxpack routes to have same AS
-            if maxpack < 2 or count % maxpack == 0:
-                aslist[-1] += 1
-                if modroot:
-                    aslist[-1] = rootas + (rootas - aslist[-1]) % modroot
-
-        if count == maxroute:
-            break
+            for subnet in range(start, start + ccount):
+                if maxpack < 2 or subnet % maxpack == 0:
+                    asn = next_root_as(asn, rootas, modroot)
+    return chunks, nextseqno
 
-        seqno += 1
-        if seqno > 0xFFFFFFFF:
-            seqno = 0
 
-    print("{} len {} routes: {}".format(prefix, sublen, count), file=sys.stderr)
+def genroutes(  # pylint: disable=R0913,R0914
+        tablefile,  # pylint: disable=R0913,R0914
+        fmtfile,  # pylint: disable=R0913,R0914
+        fmt, # pylint: disable=R0913,R0914
+        prefix,  # pylint: disable=R0913,R0914
+        sublen,  # pylint: disable=R0913,R0914
+        nexthop,  # pylint: disable=R0913,R0914
+        seqno,  # pylint: disable=R0913,R0914
+        maxpack,  # pylint: disable=R0913,R0914
+        maxroute,  # pylint: disable=R0913,R0914
+        aspath,  # pylint: disable=R0913,R0914
+        incroot,  # pylint: disable=R0913,R0914
+        modroot,  # pylint: disable=R0913,R0914
+        ts=None,  # pylint: disable=R0913,R0914
+        pool=None):  # pylint: disable=R0913,R0914
+    # Write the MRT RIB records (timestamped ts, default now) of the
+    # subnets to tablefile in chunks (in parallel with pool) and/or a line
+    # per subnet in fmt to fmtfile. Return the next sequence number.
+    if ts is None:
+        ts = int(time.time())
+    chunklist, nextseqno = get_rib_chunks(prefix, sublen, nexthop, seqno,
+                                          maxpack, maxroute, aspath, incroot,
+                                          modroot, ts)
+    if tablefile:
+        if pool:
+            results = pool.imap(gen_rib_chunk, chunklist)
+        else:
+            results = map(gen_rib_chunk, chunklist)
+        done = 0
+        for outbuf, chunk in zip(results, chunklist):
+            tablefile.write(outbuf)
+            done += chunk[4]
+            print("{} len {} routes: {}".format(prefix, sublen, done), file=sys.stderr, end='\r')
+        print("{} len {} routes: {}".format(prefix, sublen, done), file=sys.stderr)
+
+    if fmtfile:
+        for count, rprefix in enumerate(prefix.subnets(new_prefix=sublen)):
+            fmtfile.write(fmt.format(prefix=rprefix, nexthop=nexthop) + "\n")
+            if count == maxroute:
+                break
 
-    return seqno
+    return nextseqno
+
+
+# ----------------------------
+# MRT RIB to Raw Update Convert
+# ----------------------------
+
+
+def read_mrt(data):
+    # Iterate the (timestamp, type, subtype, value) of the MRT records in
+    # data (a mapped file), values are memoryviews into it.
+    offset = 0
+    dlen = len(data)
+    with memoryview(data) as view:
+        while offset + 12 <= dlen:
+            ts, typ, subtype, vlen = struct.unpack_from("!LHHL", data, offset)
+            offset += 12
+            if offset + vlen > dlen:
+                log.warning("Truncated MRT record at %d", offset - 12)
+                return
+            yield ts, typ, subtype, view[offset:offset + vlen]
+            offset += vlen
+
+
+def read_bgp4mp(data):
+    # Iterate the (time, AS size, peer address, message) of the BGP4MP (and
+    # BGP4MP_ET) message records in data, the message being a copy.
+    for ts, typ, subtype, value in read_mrt(data):
+        if typ == MRT_TYPE_BGP4MP_ET:
+            ts += struct.unpack_from("!L", value)[0] / 1000000
+            offset = 4
+        elif typ == MRT_TYPE_BGP4MP:
+            offset = 0
+        else:
+            value.release()
+            continue
+        if subtype in (BGP4MP_STYPE_MESSAGE_AS4,
+                       BGP4MP_STYPE_MESSAGE_AS4_LOCAL):
+            aslen = 4
+        elif subtype in (BGP4MP_STYPE_MESSAGE, BGP4MP_STYPE_MESSAGE_LOCAL):
+            aslen = 2
+        else:
+            value.release()
+            continue
+        # peer as, local as, interface index, afi, peer ip, local ip
+        offset += 2 * aslen + 2
+        afi = struct.unpack_from("!H", value, offset)[0]
+        iplen = 4 if afi == MPBGP_IPV4_AFI else 16
+        offset += 2
+        peerip = bytes(value[offset:offset + iplen])
+        msg = bytes(value[offset + 2 * iplen:])
+        value.release()
+        yield ts, aslen, peerip, msg
+
+
+# Size of the Bgp4mpWriter buffer, records are gathered and written out in
+# a single write(2) of (at most) this many bytes.
+BGP4MP_WRITE_BUFSIZE = 0x400000
+
+
+class Bgp4mpWriter:
+    # Records BGP messages as BGP4MP_ET MESSAGE_AS4 records (microsecond
+    # timestamps), gathered in a large buffer so recording keeps up with the
+    # session. Each record is built by copying the session's header
+    # template and patching the time and lengths into it.
+    def __init__(self, outfile, bufsize=BGP4MP_WRITE_BUFSIZE):
+        self.outfile = outfile
+        self.buf = bytearray(bufsize)
+        self.offset = 0
+        self.records = 0
+
+    @staticmethod
+    def header(peeras, localas, peerip, localip):
+        # Return the record header template of messages received from peerip
+        # (ipaddress) by localip.
+        afi = MPBGP_IPV4_AFI if peerip.version == 4 else MPBGP_IPV6_AFI
+        return struct.pack("!LHHLLLLHH", 0, MRT_TYPE_BGP4MP_ET,
+                           BGP4MP_STYPE_MESSAGE_AS4, 0, 0, peeras, localas, 0,
+                           afi) + peerip.packed + localip.packed
+
+    def write(self, header, msg, now):
+        hlen = len(header)
+        reclen = hlen + len(msg)
+        if self.offset + reclen > len(self.buf):
+            self.flush()
+        offset = self.offset
+        buf = self.buf
+        buf[offset:offset + hlen] = header
+        usec = int(now * 1000000)
+        # The length covers the microseconds, the BGP4MP header and message.
+        struct.pack_into("!L", buf, offset, usec // 1000000)
+        struct.pack_into("!LL", buf, offset + 8, reclen - 12, usec % 1000000)
+        buf[offset + hlen:offset + reclen] = msg
+        self.offset = offset + reclen
+        self.records += 1
+
+    def flush(self):
+        if self.offset:
+            with memoryview(self.buf) as view:
+                self.outfile.write(view[:self.offset])
+            self.offset = 0
+        self.outfile.flush()
+
+
+# Most segments a single writev(2)/sendmsg(2) takes.
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+# Bytes of segments a GatherWriter holds before writing them out.
+GATHER_BYTES = 0x100000
+
+
+class GatherWriter:
+    # Writes the segments (bytes-likes, not to be modified until written)
+    # given to add() with a single writev(2), or sendmsg(2) for a (blocking)
+    # socket, per IOV_MAX segments or GATHER_BYTES bytes. Messages made of
+    # separate pieces go out without concatenating them and without a
+    # syscall per message. Anything outfile has buffered is flushed first.
+    def __init__(self, outfile, maxbytes=GATHER_BYTES):
+        if hasattr(outfile, "sendmsg"):
+            self.writev = outfile.sendmsg
+        else:
+            outfile.flush()
+            fd = outfile.fileno()
+            self.writev = lambda segments: os.writev(fd, segments)
+        self.maxbytes = maxbytes
+        self.segments = []
+        self.size = 0
+
+    def add(self, *segments):
+        self.segments.extend(segments)
+        self.size += sum(len(x) for x in segments)
+        if len(self.segments) >= IOV_MAX or self.size >= self.maxbytes:
+            self.flush()
+
+    def flush(self):
+        segments = self.segments
+        while segments:
+            count = self.writev(segments[:IOV_MAX])
+            # Drop the segments written keeping the rest of a partial one.
+            done = 0
+            while done < len(segments) and count >= len(segments[done]):
+                count -= len(segments[done])
+                done += 1
+            del segments[:done]
+            if count:
+                segments[0] = memoryview(segments[0])[count:]
+        self.size = 0
+
+
+# Partial updates held by an UpdatePacker before all are written out, bounds
+# the memory used converting tables with (mostly) unique attributes.
+PACK_MAX_GROUPS = 0x100000
+
+
+class UpdatePacker:
+    # Groups prefixes by their attributes packing each group into maximal
+    # updates (of at most maxpack prefixes and maxlen bytes), written out
+    # (gathered, see GatherWriter) as soon as they are full so only a
+    # partial update per group is held.
+    def __init__(self,
+                 outfile,
+                 idxfile=None,
+                 maxpack=0xFFFF,
+                 maxlen=BGP_MAX_MSG_LEN):
+        self.offset = outfile.tell() if idxfile else 0
+        self.writer = GatherWriter(outfile)
+        self.idxfile = idxfile
+        self.maxpack = maxpack
+        self.maxlen = maxlen
+        # key -> [attrs, mpattr, trailer, pending NLRI, prefix count,
+        #         NLRI room]
+        self.groups = {}
+        self.ucount = 0
+        self.pcount = 0
+
+    def add(self, key, attrs, mpattr, nlri, trailer=b""):
+        # Add the packed prefix nlri carried with attrs (and mpattr, the
+        # MP_REACH_NLRI attribute lacking its NLRI, followed after the NLRI
+        # by the trailer attributes).
+        try:
+            group = self.groups[key]
+        except KeyError:
+            if len(self.groups) >= PACK_MAX_GROUPS:
+                self.flush()
+            group = [
+                attrs, mpattr, trailer,
+                bytearray(), 0,
+                self.maxlen - 23 - len(attrs) - len(mpattr) - len(trailer)
+            ]
+            self.groups[key] = group
+        if len(group[3]) + len(nlri) > group[5] or group[4] >= self.maxpack:
+            self.write(group)
+        group[3] += nlri
+        group[4] += 1
+        self.pcount += 1
+
+    def write(self, group):
+        attrs, mpattr, trailer, nlri, count, _ = group
+        template = make_update_template(attrs, mpattr, len(nlri), trailer)
+        mlen = len(template) + len(nlri) + len(trailer)
+        if self.idxfile:
+            self.idxfile.write(IDX_RECORD.pack(self.offset, mlen, count))
+        self.offset += mlen
+        # The NLRI is replaced, not modified, once written.
+        self.writer.add(template, nlri, trailer)
+        self.ucount += 1
+        group[3] = bytearray()
+        group[4] = 0
+
+    def flush(self):
+        for group in self.groups.values():
+            if group[3]:
+                self.write(group)
+        self.groups = {}
+        self.writer.flush()
+
+
+def split_rib_attrs(afi, attrs):
+    # Return the attributes of a RIB entry without MP_REACH_NLRI and, for
+    # IPv6, the MP_REACH_NLRI attribute (lacking NLRI) to send them with and
+    # the attributes of a higher type to follow its NLRI, keeping them in
+    # type order. RIB entries normally hold only the next hop length and
+    # address in MP_REACH_NLRI but full ones (e.g., ours) are handled too.
+    rest = bytearray()
+    trailer = bytearray()
+    mpattr = b""
+    offset = 0
+    alen = len(attrs)
+    while offset < alen:
+        aflags, atype = attrs[offset], attrs[offset + 1]
+        if aflags & BGPAF_LONGLEN:
+            vlen = struct.unpack_from("!H", attrs, offset + 2)[0]
+            vstart = offset + 4
+        else:
+            vlen = attrs[offset + 2]
+            vstart = offset + 3
+        vend = vstart + vlen
+        if atype == BGPAT_MP_REACH_NLRI:
+            value = attrs[vstart:vend]
+            if value[0] == 0:
+                # Full: afi, safi, nexthop len, nexthop
+                nexthop = bytes(value[4:4 + value[3]])
+            else:
+                nexthop = bytes(value[1:1 + value[0]])
+            mpattr = struct.pack("!BBHHBB", BGPAF_OPTIONAL | BGPAF_LONGLEN,
+                                 BGPAT_MP_REACH_NLRI, 0, afi,
+                                 MPBGP_UNICAST_SAFI, len(nexthop))
+            mpattr += nexthop + b"\x00"
+        elif atype > BGPAT_MP_REACH_NLRI:
+            trailer += attrs[offset:vend]
+        else:
+            rest += attrs[offset:vend]
+        offset = vend
+    if not mpattr:
+        return bytes(rest + trailer), mpattr, b""
+    return bytes(rest), mpattr, bytes(trailer)
+
+
+def convert_mrt(mrtfile,
+                outfile,
+                peerindex=None,
+                maxroute=0xFFFFFFFF,
+                idxfile=None,
+                maxlen=BGP_MAX_MSG_LEN):
+    # Write the unicast routes of the TABLE_DUMP_V2 RIB in mrtfile as
+    # updates of at most maxlen bytes to outfile, using the entries of peer
+    # peerindex (default the first entry of each prefix). Return the number
+    # of updates and prefixes.
+    packer = UpdatePacker(outfile, idxfile, maxlen=maxlen)
+    # Attribute splitting is cached, real tables share most attributes.
+    cache = {}
+    with mmap.mmap(mrtfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        records = read_mrt(data)
+        printed = 0
+        for _, typ, subtype, value in records:
+            try:
+                if typ != MRT_TYPE_TABLE_DUMP_V2:
+                    continue
+                if subtype == TD_STYPE_RIB_IPV4_UNICAST:
+                    afi = MPBGP_IPV4_AFI
+                elif subtype == TD_STYPE_RIB_IPV6_UNICAST:
+                    afi = MPBGP_IPV6_AFI
+                else:
+                    continue
+                # seqno, prefix, entry count
+                pend = 5 + (value[4] + 7) // 8
+                nlri = bytes(value[4:pend])
+                ecount = struct.unpack_from("!H", value, pend)[0]
+                offset = pend + 2
+                for _ in range(ecount):
+                    pindex, _, alen = struct.unpack_from(
+                        "!HLH", value, offset)
+                    offset += 8
+                    if peerindex is None or pindex == peerindex:
+                        attrs = bytes(value[offset:offset + alen])
+                        try:
+                            rest, mpattr, trailer = cache[attrs]
+                        except KeyError:
+                            rest, mpattr, trailer = split_rib_attrs(
+                                afi, attrs)
+                            cache[attrs] = rest, mpattr, trailer
+                        packer.add(attrs, rest, mpattr, nlri, trailer)
+                        break
+                    offset += alen
+            finally:
+                # The mapping can only be closed once every view is gone.
+                value.release()
+            if packer.pcount >= maxroute:
+                break
+            if packer.pcount % 10000 == 0 and packer.pcount != printed:
+                printed = packer.pcount
+                print("converted routes: {}".format(packer.pcount),
+                      file=sys.stderr, end='\r')
+        records.close()
+    packer.flush()
+    print("converted routes: {}".format(packer.pcount), file=sys.stderr)
+    return packer.ucount, packer.pcount
+
+
+# -------------------------------
+# Distribution Driven Generation
+# -------------------------------
+
+# Default prefix length and AS path length (beyond --aspath) distributions
+# as LEN:WEIGHT lists, roughly those of the current Internet tables.
+DIST_PLEN_IPV4 = "24:60,22:12,23:10,21:5,20:4,19:3,16:2,18:2,17:1,15:0.5,14:0.5"
+DIST_PLEN_IPV6 = ("48:50,32:12,44:8,40:6,29:4,36:4,46:3,47:3,45:2,42:2,34:2,"
+                  "33:2,28:1,38:1")
+DIST_ASPATH = "1:3,2:25,3:38,4:21,5:8,6:3,7:2"
+
+
+def parse_dist(spec):
+    # Return the values and weights of a LEN:WEIGHT,... distribution.
+    values, weights = [], []
+    for item in spec.split(","):
+        value, weight = item.split(":")
+        values.append(int(value))
+        weights.append(float(weight))
+    return values, weights
+
+
+def gen_dist_prefixes(prefix, count, plens, rnd):
+    # Return up to count packed NLRI prefixes of prefix with lengths drawn
+    # from the plens distribution. Each length is allocated consecutively
+    # from the start of prefix so prefixes of one length never repeat while
+    # longer ones become more specifics of shorter ones as in real tables
+    # (fewer are returned if a length fills prefix).
+    values, weights = plens
+    lens = [(x, w) for x, w in zip(values, weights)
+            if prefix.prefixlen <= x <= prefix.max_prefixlen]
+    if not lens:
+        return []
+    bits = prefix.max_prefixlen
+    base = int(prefix.network_address)
+    # [next address, step, end, NLRI length octet, address shift, octets]
+    alloc = {}
+    for plen, _ in lens:
+        nbytes = (plen + 7) // 8
+        alloc[plen] = [
+            base, 1 << (bits - plen), base + prefix.num_addresses,
+            bytes((plen, )), bits - 8 * nbytes, nbytes
+        ]
+    nlris = []
+    for plen in rnd.choices([x[0] for x in lens], [x[1] for x in lens],
+                            k=count):
+        a = alloc[plen]
+        if a[0] >= a[2]:
+            continue
+        nlris.append(a[3] + (a[0] >> a[4]).to_bytes(a[5], "big"))
+        a[0] += a[1]
+    return nlris
+
+
+def random_asn(rnd, exclude):
+    # A public 2 or 4 octet AS number not in exclude.
+    while True:
+        asn = rnd.randrange(1, 64496 + 268928)
+        if asn >= 64496:
+            asn += 131072 - 64496
+        if asn != AS_TRANS and asn not in exclude:
+            return asn
+
+
+def gen_routes_dist(  # pylint: disable=R0913,R0914
+        outfile,  # pylint: disable=R0913,R0914
+        blocks,  # pylint: disable=R0913,R0914
+        maxpack,  # pylint: disable=R0913,R0914
+        aspath,  # pylint: disable=R0913,R0914
+        plens,  # pylint: disable=R0913,R0914
+        pathlens,  # pylint: disable=R0913,R0914
+        diversity,  # pylint: disable=R0913,R0914
+        seed=0,  # pylint: disable=R0913,R0914
+        ipv4mp=False,  # pylint: disable=R0913,R0914
+        idxfile=None,  # pylint: disable=R0913,R0914
+        profile=None,  # pylint: disable=R0913,R0914
+        addpath=0,  # pylint: disable=R0913,R0914
+        maxlen=BGP_MAX_MSG_LEN):  # pylint: disable=R0913,R0914
+    # Write updates for the (prefix, count, nexthop) blocks with prefix
+    # lengths drawn from plens (by IP version), diversity distinct AS paths
+    # per prefix each aspath followed by a random tail with a length drawn
+    # from pathlens. Like origin ASes a few paths carry most prefixes (Zipf)
+    # but every path is used. The prefixes sharing a path are packed
+    # together (see UpdatePacker) in a random order. With addpath every
+    # prefix is announced with ADD-PATH path identifiers 1 to addpath, each
+    # with a newly drawn AS path. The updates are at most maxlen bytes long.
+    # The same seed gives the same updates.
+    rnd = random.Random(seed)
+    aslist = [int(x) for x in aspath if x]
+    packer = UpdatePacker(outfile, idxfile, maxpack, maxlen)
+    keybase = 0
+    for prefix, count, nexthop in blocks:
+        nlris = gen_dist_prefixes(prefix, count, plens[prefix.version], rnd)
+        if len(nlris) < count:
+            log.warning("%s only has room for %d of %d prefixes", prefix,
+                        len(nlris), count)
+        if not nlris:
+            continue
+        npaths = max(1, min(len(nlris), int(len(nlris) * diversity)))
+        attrsets = []
+        for plen in rnd.choices(pathlens[0], pathlens[1], k=npaths):
+            path = aslist + [random_asn(rnd, aslist) for _ in range(plen)]
+            attrsets.append(get_attrs(path, nexthop, False, ipv4mp, profile))
+        picks = list(range(npaths))
+        picks += rnd.choices(
+            picks,
+            cum_weights=list(
+                itertools.accumulate(1 / (x + 1) for x in range(npaths))),
+            k=len(nlris) - npaths)
+        for pathid in range(1, addpath + 1) if addpath else (0, ):
+            rnd.shuffle(picks)
+            pathbytes = pathid.to_bytes(4, "big") if pathid else b""
+            for nlri, pick in zip(nlris, picks):
+                attrs, mpattr, trailer = attrsets[pick]
+                packer.add(keybase + pick, attrs, mpattr, pathbytes + nlri,
+                           trailer)
+        keybase += npaths
+        print("{} routes: {} paths: {}".format(prefix, len(nlris), npaths),
+              file=sys.stderr)
+    packer.flush()
+    return packer.ucount, packer.pcount
 
 
 def genribhdr():
@@ -498,16 +1353,129 @@ def triples(l):
         return
 
 
+def get_blocks(tuples, maxroute):
+    # Return (prefix, sublen, nexthop, count) for each PREFIX SUBLEN NEXTHOP
+    # triple, the counts limited so their total does not exceed maxroute.
+    blocks = []
+    for pfx, sublen, nexthop in triples(tuples):
+        if maxroute <= 0:
+            break
+        prefix = ipaddress.ip_network(pfx)
+        nexthop = ipaddress.ip_address(nexthop)
+        sublen = int(sublen)
+        assert prefix.version == nexthop.version
+        count = min(1 << (sublen - prefix.prefixlen), maxroute)
+        blocks.append((prefix, sublen, nexthop, count))
+        maxroute -= count
+    return blocks
+
+
+def get_dist_blocks(tuples, maxroute):
+    # Return (prefix, count, nexthop) for each --dist PREFIX COUNT NEXTHOP
+    # triple, the counts limited so their total does not exceed maxroute.
+    blocks = []
+    for pfx, count, nexthop in triples(tuples):
+        if maxroute <= 0:
+            break
+        prefix = ipaddress.ip_network(pfx)
+        nexthop = ipaddress.ip_address(nexthop)
+        assert prefix.version == nexthop.version
+        count = min(int(count), maxroute)
+        blocks.append((prefix, count, nexthop))
+        maxroute -= count
+    return blocks
+
+
+# The expected RIB file describes the generated prefixes as blocks of count
+# consecutive subnets of length sublen starting at prefix. Receivers build a
+# bitmap per block from it so membership is index math.
+def write_expected(outfile, blocks):
+    outfile.write("# PREFIX SUBLEN NEXTHOP COUNT\n")
+    for prefix, sublen, nexthop, count in sorted(
+            blocks, key=lambda x: (x[0].version, x[0], x[1])):
+        outfile.write("{} {} {} {}\n".format(prefix, sublen, nexthop, count))
+
+
+def read_expected(infile):
+    # Return the blocks of an expected RIB file in the form get_blocks()
+    # returns them.
+    blocks = []
+    for line in infile:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        pfx, sublen, nexthop, count = line.split()
+        blocks.append((ipaddress.ip_network(pfx), int(sublen),
+                       ipaddress.ip_address(nexthop), int(count)))
+    return blocks
+
+
 def main():
     parser = argparse.ArgumentParser("Inject BGP route file into peer")
+    parser.add_argument(
+        "--add-path",
+        type=int,
+        default=0,
+        help="Announce each --update prefix N times with ADD-PATH path ids")
+    parser.add_argument(
+        "--aspath-dist",
+        default=DIST_ASPATH,
+        help="--dist LEN:WEIGHT,... of AS path lengths beyond --aspath")
     parser.add_argument(
         "--debug", action="store_true", help="Enable debug logging")
+    parser.add_argument(
+        "--dist",
+        action="store_true",
+        help="Generate PREFIX COUNT NEXTHOP triples of --update routes with "
+        "realistic prefix length, AS path length and attribute distributions")
+    parser.add_argument(
+        "--diversity",
+        type=float,
+        default=0.3,
+        help="--dist ratio of distinct AS paths to prefixes [default: 0.3]")
     parser.add_argument(
         "--dump-format", default="    {prefix} via {nexthop};", help="Format to use for format dumped")
     parser.add_argument(
         "--aspath", default="20", help="comma sep list of asnumbers")
+    parser.add_argument(
+        "--communities",
+        type=int,
+        default=0,
+        help="Number of COMMUNITIES to add to --update routes")
+    parser.add_argument(
+        "-c",
+        "--convert",
+        help="Write the routes of this MRT TABLE_DUMP_V2 file as --update updates")
+    parser.add_argument(
+        "-e",
+        "--expect-file",
+        help="File to write the expected RIB index of generated prefixes into")
+    parser.add_argument(
+        "--extended-message",
+        action="store_true",
+        help="Pack --update updates into up to 65535 rather than 4096 bytes "
+        "(RFC 8654)")
     parser.add_argument(
         "-f", "--format-file", help="File to write For table dump into")
+    parser.add_argument(
+        "--ipv4-mp",
+        action="store_true",
+        help="Send IPv4 routes in MP_REACH_NLRI rather than with NEXT_HOP")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes generating updates [default: 1, 0 all cores]")
+    parser.add_argument(
+        "--large-communities",
+        type=int,
+        default=0,
+        help="Number of LARGE_COMMUNITY values to add to --update routes")
+    parser.add_argument(
+        "--local-pref",
+        type=int,
+        help="LOCAL_PREF to add to --update routes (for iBGP peers)")
     parser.add_argument(
         "-m",
         "--max-routes",
@@ -519,6 +1487,22 @@ def main():
         type=int,
         default=0xFFFF,
         help="Maximum number of prefixes to generate [default: 4 billion]")
+    parser.add_argument(
+        "--med",
+        type=int,
+        help="MED to add to --update routes (raised by 1 per ADD-PATH path)")
+    parser.add_argument(
+        "--mrt-peer",
+        type=int,
+        help="Convert the routes of this peer index [default: first of each prefix]")
+    parser.add_argument(
+        "--plen-dist4",
+        default=DIST_PLEN_IPV4,
+        help="--dist LEN:WEIGHT,... of IPv4 prefix lengths")
+    parser.add_argument(
+        "--plen-dist6",
+        default=DIST_PLEN_IPV6,
+        help="--dist LEN:WEIGHT,... of IPv6 prefix lengths")
     parser.add_argument(
         "-p",
         "--peers",
@@ -530,10 +1514,25 @@ def main():
         type=int,
         default=0,
         help="modulus the incrementing root as")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="--dist random seed, the same seed gives the same updates")
     parser.add_argument(
         "-t", "--tabledump", help="File to write MRT table dump into")
     parser.add_argument(
         "-u", "--update", help="File to write BGP updates into")
+    parser.add_argument(
+        "-x",
+        "--index",
+        action="store_true",
+        help="Also write an index of the --update file messages into FILE.idx")
+    parser.add_argument(
+        "-w",
+        "--withdraw",
+        action="store_true",
+        help="Write updates withdrawing rather than announcing the routes")
     parser.add_argument(
         "tuples", nargs="*", help="PREFIX SUBLEN NEXTHOP pairs")
     args = parser.parse_args()
@@ -545,75 +1544,121 @@ def main():
     modroot = args.root_as_mod
     maxroute = args.max_routes
     maxpack = args.max_pack
+    profile = get_profile(args.med, args.local_pref, args.communities,
+                          args.large_communities)
+    maxlen = BGP_EXT_MAX_MSG_LEN if args.extended_message else BGP_MAX_MSG_LEN
 
     if len(args.tuples) % 3:
         log.error("Prefix sublen args must come in triples\n")
         sys.exit(1)
 
-    if args.update:
-        if args.update == "-":
-            assert args.tabledump != "-" and args.format_file != "-"
-            outfile = sys.stdout.buffer
-        else:
-            outfile = open(args.update, "wb")
-        routecount = 0
-        updatecount = 0
-        for pfx, sublen, nexthop in triples(args.tuples):
-            prefix = ipaddress.ip_network(pfx)
-            nexthop = ipaddress.ip_address(nexthop)
-            assert prefix.version == nexthop.version
-            ucount, count = gen_routes_update(outfile, prefix, int(sublen),
-                                              nexthop, maxpack, maxroute,
-                                              aspath, incroot, modroot)
-            updatecount += ucount
-            routecount += count
-            maxroute -= count
-            if maxroute <= 0:
-                break
-        log.info("Wrote {} BGP updates with {} total NLRI".format(
-            updatecount, routecount))
-
-    if args.tabledump or args.format_file:
-        tablefile = None
-        if args.tabledump == "-":
-            assert args.update != "-" and args.format_file != "-"
-            tablefile = sys.stdout.buffer
-        elif args.tabledump:
-            tablefile = open(args.tabledump, "wb")
-
-        fmtfile = None
-        if args.format_file == "-":
-            assert args.update != "-" and args.tabledump != "-"
-            fmtfile = sys.stdout
-        elif args.format_file:
-            fmtfile = open(args.format_file, "w")
-
-
-        # -------------------------
-        # Generate Peer Index Table
-        # -------------------------
-
-        if tablefile:
-          peerlist = [X.split(",") for X in args.peers.split()]
-          peers = [(ipaddress.ip_address(x), ipaddress.ip_address(y), int(z))
-                  for x, y, z in peerlist]
-          peerfile = io.BytesIO()
-          genpeers(peerfile, peers)
-          mrtencode(outfile, MRT_TYPE_TABLE_DUMP_V2, TD_STYPE_PEER_INDEX_TABLE,
-                    peerfile.getvalue())
-
-        # ---------------
-        # Generate Routes
-        # ---------------
-
-        seqno = 0
-        for pfx, sublen, nexthop in triples(args.tuples):
-            prefix = ipaddress.ip_network(pfx)
-            nexthop = ipaddress.ip_address(nexthop)
-            assert prefix.version == nexthop.version
-            seqno = genroutes(tablefile, fmtfile, args.dump_format, prefix, int(sublen), nexthop, seqno,
-                              maxpack, maxroute, aspath, incroot, modroot)
-        log.info("Total routes: {}".format(seqno))
+    if args.dist and (args.expect_file or args.tabledump or args.format_file):
+        log.error("--dist only generates --update files\n")
+        sys.exit(1)
+
+    if args.dist and (args.withdraw or args.root_as_inc or args.root_as_mod
+                      or args.jobs != 1):
+        log.error("--dist can't be used with -w, --root-as-inc, "
+                  "--root-as-mod or -j\n")
+        sys.exit(1)
+
+    if args.expect_file:
+        with open(args.expect_file, "w") as expfile:
+            write_expected(expfile, get_blocks(args.tuples, maxroute))
+
+    # The pool (if any) is terminated on the way out, every chunk having
+    # been collected.
+    if args.jobs != 1:
+        pool = multiprocessing.Pool(args.jobs or None)
+    else:
+        pool = contextlib.nullcontext()
+    with pool as pool:
+        if args.update:
+            if args.update == "-":
+                assert args.tabledump != "-" and args.format_file != "-"
+                outfile = sys.stdout.buffer
+            else:
+                outfile = open(args.update, "wb")
+            idxfile = None
+            if args.index:
+                assert args.update != "-"
+                idxfile = open(get_index_path(args.update), "wb")
+                idxfile.write(IDX_MAGIC)
+            routecount = 0
+            updatecount = 0
+            if args.convert:
+                with open(args.convert, "rb") as mrtfile:
+                    updatecount, routecount = convert_mrt(
+                        mrtfile, outfile, args.mrt_peer, maxroute, idxfile,
+                        maxlen)
+            if args.dist:
+                ucount, count = gen_routes_dist(
+                    outfile,
+                    get_dist_blocks(args.tuples, maxroute - routecount),
+                    maxpack, aspath, {
+                        4: parse_dist(args.plen_dist4),
+                        6: parse_dist(args.plen_dist6)
+                    }, parse_dist(args.aspath_dist), args.diversity, args.seed,
+                    args.ipv4_mp, idxfile, profile, args.add_path, maxlen)
+                updatecount += ucount
+                routecount += count
+            # Converted routes count towards --max-routes too.
+            for prefix, sublen, nexthop, maxcount in get_blocks(
+                    [] if args.dist else args.tuples, maxroute - routecount):
+                ucount, count = gen_routes_update(
+                    outfile, prefix, sublen, nexthop, maxpack, maxcount,
+                    aspath, incroot, modroot, pool, args.withdraw, idxfile,
+                    args.ipv4_mp, profile, args.add_path, maxlen)
+                updatecount += ucount
+                routecount += count
+            log.info("Wrote {} BGP updates with {} total NLRI".format(
+                updatecount, routecount))
+            if idxfile:
+                idxfile.close()
+
+        if args.tabledump or args.format_file:
+            tablefile = None
+            if args.tabledump == "-":
+                assert args.update != "-" and args.format_file != "-"
+                tablefile = sys.stdout.buffer
+            elif args.tabledump:
+                tablefile = open(args.tabledump, "wb")
+
+            fmtfile = None
+            if args.format_file == "-":
+                assert args.update != "-" and args.tabledump != "-"
+                fmtfile = sys.stdout
+            elif args.format_file:
+                fmtfile = open(args.format_file, "w")
+
+            # A single timestamp for the whole dump.
+            ts = int(time.time())
+
+            # -------------------------
+            # Generate Peer Index Table
+            # -------------------------
+
+            if tablefile:
+              peerlist = [X.split(",") for X in args.peers.split()]
+              peers = [(ipaddress.ip_address(x), ipaddress.ip_address(y), int(z))
+                      for x, y, z in peerlist]
+              peerfile = io.BytesIO()
+              genpeers(peerfile, peers)
+              mrtencode(tablefile, MRT_TYPE_TABLE_DUMP_V2, TD_STYPE_PEER_INDEX_TABLE,
+                        peerfile.getvalue(), ts)
+
+            # ---------------
+            # Generate Routes
+            # ---------------
+
+            seqno = 0
+            for pfx, sublen, nexthop in triples(args.tuples):
+                prefix = ipaddress.ip_network(pfx)
+                nexthop = ipaddress.ip_address(nexthop)
+                assert prefix.version == nexthop.version
+                seqno = genroutes(tablefile, fmtfile, args.dump_format, prefix, int(sublen), nexthop, seqno,
+                                  maxpack, maxroute, aspath, incroot, modroot, ts, pool)
+            log.info("Total routes: {}".format(seqno))
 
 
 if __name__ == "__main__":